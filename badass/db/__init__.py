@@ -1,4 +1,6 @@
-import csv, secrets, configparser, ast
+import csv, secrets, configparser, ast, threading
+
+from contextlib import contextmanager
 
 from pydal import DAL, Field
 from sqlite3 import IntegrityError
@@ -24,6 +26,7 @@ class Roles (object) :
 
 class BaseUser (dict) :
     db = None
+    _local = threading.local()
     _fields = {"id" : 0,
                "email" : None,
                "firstname" : None,
@@ -48,15 +51,41 @@ class BaseUser (dict) :
         try :
             cls.db.users.insert(password=passwd, salt=salt, **fields)
         except IntegrityError :
-            cls.db.rollback()
+            # SQLite only cancels the failed insert, not a pending batch
+            if not cls._batching() :
+                cls.db.rollback()
             return False
         except :
             cls.db.rollback()
             raise
         else :
-            cls.db.commit()
+            cls._commit()
         return cls(**fields)
     @classmethod
+    @contextmanager
+    def batch (cls) :
+        "commit only once at the end of the block, eg, for bulk imports"
+        depth = cls._batching()
+        cls._local.batch = depth + 1
+        try :
+            yield
+        except :
+            cls._local.batch = depth
+            if not depth :
+                cls.db.rollback()
+            raise
+        else :
+            cls._local.batch = depth
+            if not depth :
+                cls.db.commit()
+    @classmethod
+    def _batching (cls) :
+        return getattr(cls._local, "batch", 0)
+    @classmethod
+    def _commit (cls) :
+        if not cls._batching() :
+            cls.db.commit()
+    @classmethod
     def from_id (cls, user_id) :
         fields = dict(cls.db(cls.db.users.id == user_id).select().first())
         if not fields :
@@ -83,7 +112,7 @@ class BaseUser (dict) :
                 cls.db.rollback()
                 raise
             else :
-                cls.db.commit()
+                cls._commit()
         fields["activated"] = fields["authenticated"] = True
         return cls(**fields)
     @classmethod
@@ -109,13 +138,17 @@ class BaseUser (dict) :
     def has_role (self, role) :
         return role in self.roles
     def delete (self) :
+        users = self.db(self.db.users.email == self.email)
         try :
-            done = self.db(self.db.users.email == self.email).delete()
+            row = users.select(self.db.users.group).first()
+            done = users.delete()
+            if done :
+                catalogue_refresh(self.db, row.group)
         except :
             self.db.rollback()
             raise
         else :
-            self.db.commit()
+            self._commit()
         return done > 0
     def update (self, **fields) :
         assert set(fields) <= {"email", "firstname", "lastname", "password",
@@ -127,13 +160,16 @@ class BaseUser (dict) :
             fields["password"] = salthash(row["salt"], fields["password"])
         if "roles" in fields :
             fields["roles"] = list(sorted(fields["roles"]))
+        group = row["group"]
         try :
             row.update_record(**fields)
+            if fields.get("group", group) != group :
+                catalogue_refresh(self.db, group, fields["group"])
         except :
             self.db.rollback()
             raise
         else :
-            self.db.commit()
+            self._commit()
         return True
 
 class cfgtree (dict) :
@@ -159,9 +195,39 @@ class cfgtree (dict) :
             else :
                 yield key, val
 
+def catalogue_add (db, course, exercise, user) :
+    """record that the group of `user` (an id) has submissions for
+    `course/exercise` (no commit)
+
+    The group is read from the database, not from a session that may have been
+    opened before the user was moved to another group.
+    """
+    db.executesql('INSERT OR IGNORE INTO catalogue (course, exercise, "group")'
+                  ' SELECT ?, ?, users."group" FROM users WHERE users.id = ?',
+                  (course, exercise, user))
+
+def catalogue_refresh (db, *groups) :
+    "rebuild the catalogue entries of `groups` from the submissions (no commit)"
+    marks = ", ".join("?" for g in groups)
+    db.executesql(f'DELETE FROM catalogue WHERE "group" IN ({marks})', groups)
+    db.executesql('INSERT OR IGNORE INTO catalogue (course, exercise, "group")'
+                  ' SELECT DISTINCT submissions.course, submissions.exercise,'
+                  ' users."group" FROM submissions'
+                  " JOIN users ON users.id = submissions.user"
+                  f' WHERE users."group" IN ({marks})', groups)
+
+def _sqlite_setup (adapter) :
+    # called for every new connection, pydal opening one per thread, so that
+    # readers do not block writers and writers wait for each other (for the
+    # timeout passed to sqlite3.connect) instead of failing
+    adapter.connection.execute("PRAGMA journal_mode=WAL")
+    adapter.connection.execute("PRAGMA synchronous=NORMAL")
+
 def connect (path) :
     # sqlite DB
-    db = DAL(f"sqlite://badass.sqlite", folder=path)
+    db = DAL(f"sqlite://badass.sqlite", folder=path,
+             driver_args={"timeout" : 30},
+             after_connection=_sqlite_setup)
     db.define_table("users",
                     Field("email", "string", unique=True),
                     Field("firstname", "string"),
@@ -177,11 +243,36 @@ def connect (path) :
                     Field("date", "datetime"),
                     Field("course", "string"),
                     Field("exercise", "string"),
-                    Field("path", "string"))
+                    Field("path", "string"),
+                    Field("digest", "string"),
+                    Field("cached", "boolean", default=False))
+    # (course, exercise, group) that have submissions, maintained on insert and
+    # when users change group or are deleted
+    db.define_table("catalogue",
+                    Field("course", "string"),
+                    Field("exercise", "string"),
+                    Field("group", "string"))
+    # indexes for report and user pages lookups
+    # (users.email being unique is already indexed)
+    db.executesql("CREATE INDEX IF NOT EXISTS submissions_course_exercise_user"
+                  " ON submissions (course, exercise, user)")
+    db.executesql("CREATE INDEX IF NOT EXISTS submissions_user_date"
+                  " ON submissions (user, date)")
+    db.executesql("CREATE INDEX IF NOT EXISTS submissions_digest"
+                  " ON submissions (digest)")
+    db.executesql('CREATE INDEX IF NOT EXISTS users_group ON users ("group")')
+    db.executesql("CREATE UNIQUE INDEX IF NOT EXISTS catalogue_entry"
+                  ' ON catalogue (course, exercise, "group")')
+    if db(db.catalogue).isempty() :
+        db.executesql('INSERT OR IGNORE INTO catalogue (course, exercise, "group")'
+                      ' SELECT DISTINCT submissions.course, submissions.exercise,'
+                      ' users."group" FROM submissions'
+                      " JOIN users ON users.id = submissions.user")
+    db.commit()
     # configuration
     config = configparser.ConfigParser()
     config.read(f"{path}/badass.cfg")
-    cfg = cfgtree("CODES", "GROUPS")
+    cfg = cfgtree("CODES", "GROUPS", "TASKS")
     for sec in config :
         for key, val in config[sec].items() :
             try :
@@ -0,0 +1,90 @@
+"""content-addressed storage of submitted files
+
+Every file is stored once in a `BlobStore`, named after the SHA-256 of its
+content. The files of a submission are replaced by hard links to their blobs,
+so that they remain usable as regular files, and listed in a manifest saved
+in the submission directory, so that they can be read without walking it.
+"""
+
+import hashlib, json, os, secrets
+
+from pathlib import Path
+
+MANIFEST = "manifest.json"
+
+def _digest (path) :
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream :
+        for block in iter(lambda: stream.read(1 << 16), b"") :
+            digest.update(block)
+    return digest.hexdigest()
+
+def _blob (root, digest) :
+    return Path(root) / digest[:2] / digest[2:]
+
+def _link (source, target) :
+    # atomically replace target with a hard link to source
+    tmp = target.with_name(f".{target.name}.{secrets.token_hex(8)}")
+    os.link(source, tmp)
+    os.replace(tmp, target)
+
+class BlobStore (object) :
+    def __init__ (self, root) :
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+    def path (self, digest) :
+        return _blob(self.root, digest)
+    def add (self, path) :
+        "store file `path` and replace it with a link to its blob"
+        path = Path(path)
+        digest = _digest(path)
+        blob = self.path(digest)
+        try :
+            if not blob.exists() :
+                blob.parent.mkdir(exist_ok=True)
+                _link(path, blob)
+            elif not blob.samefile(path) :
+                _link(blob, path)
+        except OSError :
+            # store is on another file system, keep the file as is
+            pass
+        return digest
+    def archive (self, base, *paths) :
+        """store the files found in `paths` (files or directories inside `base`)
+        and save the manifest of `base`"""
+        base = Path(base)
+        files = {}
+        todo = [Path(p) for p in paths]
+        dirs = sorted(str(p.relative_to(base)) for p in todo if p.is_dir())
+        while todo :
+            path = todo.pop()
+            if path.is_dir() :
+                todo.extend(path.iterdir())
+            elif path.is_file() :
+                files[str(path.relative_to(base))] = self.add(path)
+        manifest = {"store" : os.path.relpath(self.root, base),
+                    "dirs" : dirs,
+                    "files" : dict(sorted(files.items()))}
+        with (base / MANIFEST).open("w", encoding="utf-8") as out :
+            json.dump(manifest, out)
+        return manifest
+
+def manifest (base) :
+    """read the manifest of `base`, or return `None` if there is no manifest
+
+    Return a pair `files, dirs` where `files` maps the path of every stored
+    file (relative to `base`) to the path of its blob, and `dirs` is the set
+    of directories whose content is entirely stored.
+    """
+    base = Path(base)
+    try :
+        with (base / MANIFEST).open(encoding="utf-8") as stream :
+            data = json.load(stream)
+    except (OSError, ValueError) :
+        return None
+    files = {}
+    for name, digest in data["files"].items() :
+        blob = _blob(base / data["store"], digest)
+        # fallback to the file itself if it could not be stored
+        files[name] = blob if blob.exists() else base / name
+    return files, set(data["dirs"])
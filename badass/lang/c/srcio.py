@@ -1,4 +1,6 @@
-import subprocess, json, io, collections, pathlib
+import subprocess, json, io, collections, pathlib, os
+
+from concurrent.futures import ThreadPoolExecutor
 
 from pathlib import Path
 
@@ -37,7 +39,7 @@ def tidy (sig, decl=None) :
             return obj["type"]["qualType"]
 
 class Source (object) :
-    def __init__ (self, *paths) :
+    def __init__ (self, *paths, jobs=None) :
         self.base_dir = None
         files = []
         for path in (Path(p) for p in paths) :
@@ -49,7 +51,7 @@ class Source (object) :
             if path.is_dir() :
                 # check if it's relative to identified base directory
                 path.relative_to(self.base_dir)
-                files.extend(path.glob("*.[ch]"))
+                files.extend(sorted(path.glob("*.[ch]")))
             else :
                 # check if it's relative to identified base directory
                 path.relative_to(self.base_dir)
@@ -58,10 +60,15 @@ class Source (object) :
         self.obj = {}
         self.sig = collections.defaultdict(list)
         self.src = {}
-        for path in files :
-            recode(path)
-            self.parse(path)
-    def parse (self, path) :
+        # clang is run concurrently on all the files, but its results are merged
+        # in the order of the files so that `obj` and `sig` are deterministic
+        with ThreadPoolExecutor(jobs or os.cpu_count()) as pool :
+            for _path, ast in pool.map(self._load, files) :
+                self._merge(_path, ast)
+    def _load (self, path) :
+        recode(path)
+        return self._clang(path)
+    def _clang (self, path) :
         _path = str(path.relative_to(self.base_dir))
         source = io.StringIO()
         with open(path, **encoding) as src :
@@ -74,7 +81,10 @@ class Source (object) :
                               input=source.getvalue(),
                               capture_output=True,
                               **encoding)
-        ast = tree(json.loads(done.stdout))
+        return _path, tree(json.loads(done.stdout))
+    def parse (self, path) :
+        self._merge(*self._clang(path))
+    def _merge (self, _path, ast) :
         self.ast[_path] = {"clang" : ast}
         for decl in query("$..*[?kind='FunctionDecl']", ast) :
             if decl.get("isImplicit", False) :
@@ -1,10 +1,11 @@
-import ast, collections
+import ast, collections, hashlib, re, functools
 
 from pathlib import Path
 
 from tree_sitter import Language, Parser
 
 from ... import encoding
+from ...run.queries import hlist, hcons
 
 import badass.lang
 
@@ -12,25 +13,44 @@ JAVA = Language(Path(badass.lang.__file__).parent / "tslib.so", "java")
 parser = Parser()
 parser.set_language(JAVA)
 
+@functools.lru_cache(maxsize=None)
+def _query (query) :
+    return JAVA.query(query)
+
 def _query_captures (query, root) :
     # this fixes duplicated captured nodes when * is used in queries
     seen = set()
-    for node, name in JAVA.query(query).captures(root) :
-        nsig = (name, node.start_byte, node.end_byte, node.sexp())
+    for node, name in _query(query).captures(root) :
+        nsig = (name, node.id)
         if nsig not in seen :
             seen.add(nsig)
             yield name, node
 
+def _digest (src) :
+    return hashlib.sha1(src).hexdigest()
+
 class SourceTree (object) :
+    # recently parsed trees, so that a file edited back to a previous content is
+    # not parsed again
+    _parsed = collections.OrderedDict()
+    _parsed_max = 128
     def __init__ (self, src, path=None, kind=None, nodes=[]) :
         if isinstance(src, str) :
             src = src.encode("utf-8")
         self.src = src
         self.path = path
-        self.tree = parser.parse(src)
+        key = _digest(src)
+        if key in self._parsed :
+            self._parsed.move_to_end(key)
+            self.tree = self._parsed[key]
+        else :
+            self.tree = self._parsed[key] = parser.parse(src)
+            if len(self._parsed) > self._parsed_max :
+                self._parsed.popitem(last=False)
         self.root = self.tree.root_node
         self.nodes = list(nodes)
         self.kind = kind
+        self._hcons = {}
     def __getitem__ (self, node) :
         return self.src[node.start_byte:node.end_byte].decode("utf-8")
     def __bool__ (self) :
@@ -42,6 +62,7 @@ class SourceTree (object) :
             if node.type not in self._dump_ignore :
                 yield self.dump(node)
     def dump (self, node=None) :
+        # dumped nodes are hash-consed so that TQL hashes them in constant time
         if node is None :
             node = self.root
         assert node.type not in self._dump_ignore
@@ -64,16 +85,19 @@ class SourceTree (object) :
                 if not cursor.goto_next_sibling() :
                     break
             if children :
-                tree["children"] = children
-        return tree
+                tree["children"] = hcons(hlist(children), self._hcons)
+        return hcons(tree, self._hcons)
     def errors (self, node=None) :
         if node is None :
             node = self.root
-        if node.type in ("ERROR", "MISSING") :
-            yield node
-        else :
-            for child in node.children :
-                yield from self.errors(child)
+        todo = [node]
+        while todo :
+            node = todo.pop()
+            if node.type in ("ERROR", "MISSING") :
+                yield node
+            elif node.has_error :
+                # only subtrees with errors need to be searched
+                todo.extend(reversed(node.children))
     def errors_span (self, node=None) :
         return sum((n.end_byte - n.start_byte + 1 for n in self.errors(node)), 0)
     def __call__ (self, query, root=None) :
@@ -83,47 +107,73 @@ class SourceTree (object) :
         for name, node in _query_captures(query, root) :
             match[name].append(node)
         return dict(match)
+    _wrap = {"static" : ("class StaticProgram { void setup() {\n", "\n} }",
+                         """(program
+                             (class_declaration
+                              body: (class_body
+                                     (method_declaration
+                                      body: (block
+                                             (_) @node
+                         )))))"""),
+             "dynamic" : ("class DynamicProgram {\n", "\n}",
+                          """(program
+                              (class_declaration
+                               body: (class_body
+                                      (_) @node
+                          )))""")}
+    # a method defined at the top-level can only be a dynamic sketch
+    _dynamic = re.compile(r"^[ \t]*(?:(?:public|private|protected|static|final)\s+)*"
+                          r"(?!(?:else|new|return)\b)[\w.]+(?:\s*<[\w\s,.<>?]*>)?(?:\s*\[\s*\])*"
+                          r"\s+(?!(?:if|for|while|switch|catch|synchronized)\b)\w+"
+                          r"\s*\([^;{}]*\)\s*(?:throws\s+[\w.,\s]+)?\{",
+                          re.M)
+    # kinds of recently seen sources, indexed by their digest
+    _kinds = collections.OrderedDict()
+    _kinds_max = 128
     @classmethod
     def parse (cls, path, kind=None) :
         path = Path(path)
         src = path.read_text(**encoding)
         if kind not in ("static", "dynamic", None) :
             raise ValueError(f"unknown program kind: {kind!r}")
-        if kind in ("static", None) :
-            s_tree = cls("class StaticProgram { void setup() {\n" + src + "\n} }",
-                         path=path,
-                         kind="static")
-            s_query = """(program
-                          (class_declaration
-                           body: (class_body
-                                  (method_declaration
-                                   body: (block
-                                          (_) @node
-            )))))"""
-        if kind in ("dynamic", None) :
-            d_tree = cls("class DynamicProgram {\n" + src + "\n}",
-                         path=path,
-                         kind="dynamic")
-            d_query = """(program
-                          (class_declaration
-                           body: (class_body
-                                  (_) @node
-            )))"""
         if kind is None :
-            if s_tree.errors_span() < d_tree.errors_span() :
+            key = _digest(src.encode("utf-8"))
+            kind = cls._kinds.get(key, None)
+            if kind is not None :
+                cls._kinds.move_to_end(key)
+        if kind is None :
+            trees = {}
+            if cls._dynamic.search(src) :
+                trees["dynamic"] = cls._wrapped(src, path, "dynamic")
+                if trees["dynamic"].root.has_error :
+                    trees["static"] = cls._wrapped(src, path, "static")
+            else :
+                trees["static"] = cls._wrapped(src, path, "static")
+                trees["dynamic"] = cls._wrapped(src, path, "dynamic")
+            if "static" not in trees :
+                kind = "dynamic"
+            elif trees["static"].errors_span() < trees["dynamic"].errors_span() :
                 kind = "static"
             else :
                 kind = "dynamic"
-        if kind == "static" :
-            tree, query = s_tree, s_query
+            cls._kinds[key] = kind
+            if len(cls._kinds) > cls._kinds_max :
+                cls._kinds.popitem(last=False)
+            tree = trees[kind]
         else :
-            tree, query = d_tree, d_query
-        tree.nodes = tuple(node for node in tree(query)["node"])
+            tree = cls._wrapped(src, path, kind)
+        tree.nodes = tuple(node for node in tree(cls._wrap[kind][2])["node"])
         return tree
+    @classmethod
+    def _wrapped (cls, src, path, kind) :
+        head, tail, _ = cls._wrap[kind]
+        return cls(head + src + tail, path=path, kind=kind)
     def discard (self, node) :
-        with self.path.open("w", **encoding) as out :
-            out.write(self.src[:node.start_byte].encode("utf-8"))
-            out.write(self.src[node.end_byte:].encode("utf-8"))
+        head, tail, _ = self._wrap[self.kind]
+        start, end = len(head.encode("utf-8")), len(self.src) - len(tail.encode("utf-8"))
+        with self.path.open("wb") as out :
+            out.write(self.src[start:node.start_byte])
+            out.write(self.src[node.end_byte:end])
         tree = self.parse(self.path, self.kind)
         if not tree.nodes :
             tree.path.unlink()
@@ -1,5 +1,8 @@
-import collections
+import collections, weakref, contextlib, threading
 
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from collections.abc import Iterable
 from tree_sitter import Language, Parser as TSParser, Node
@@ -12,10 +15,218 @@ from .. import tree, encoding
 
 import badass.lang
 
+#
+# compact AST storage
+#
+
+class CompactAST (object) :
+    """an AST stored as flat arrays instead of nested `tree`s
+
+    Each node is numbered and stored as:
+     - `kind[n]`: index of its kind in `strings`
+     - `parent[n]`: number of its parent node (`-1` for the root)
+     - `first[n]`, `count[n]`: slice of `links` that holds its children
+     - `start[n]`, `end[n]`: its bytes range in the source
+     - `src[n]`: index of its source code in `strings` (`-1` if none)
+
+    Each child number in `links` is paired with the index of its field name
+    in `strings`, stored in `fields` (`-1` for the anonymous children that
+    are reachable through key `"children"`).
+
+    `orphans` is set when some nodes are not reachable from the root, which
+    happens when ERROR nodes are skipped while dumping, `pack` then returns a
+    copy of the AST without them.
+
+    Nodes are accessed through `CompactNode` views that are created on demand
+    and kept as long as they are referenced elsewhere, so that the same node
+    is always viewed by the same object (as expected by `Q` sets operations).
+    """
+    def __init__ (self, path=None, location=True) :
+        self.path = path
+        self.location = location
+        self.strings = []
+        self._strings = {}
+        self.kind = array("I")
+        self.parent = array("i")
+        self.first = array("I")
+        self.count = array("I")
+        self.start = array("I")
+        self.end = array("I")
+        self.src = array("i")
+        self.links = array("I")
+        self.fields = array("i")
+        self.orphans = False
+        self._views = weakref.WeakValueDictionary()
+    def __len__ (self) :
+        return len(self.kind)
+    def string (self, txt) :
+        "index of `txt` in the strings table"
+        if txt not in self._strings :
+            self._strings[txt] = len(self.strings)
+            self.strings.append(txt)
+        return self._strings[txt]
+    def add (self, kind, start, end) :
+        "add a new node without children, return its number"
+        num = len(self.kind)
+        self.kind.append(self.string(kind))
+        self.parent.append(-1)
+        self.first.append(0)
+        self.count.append(0)
+        self.start.append(start)
+        self.end.append(end)
+        self.src.append(-1)
+        return num
+    def link (self, num, children) :
+        "set the children of node `num` given as `(child, field_name)` pairs"
+        self.first[num] = len(self.links)
+        self.count[num] = len(children)
+        for child, name in children :
+            self.parent[child] = num
+            self.links.append(child)
+            self.fields.append(-1 if name is None else self.string(name))
+    def pack (self, root) :
+        "copy of the AST made of node `root` and its descendants only"
+        ast = self.__class__(self.path, self.location)
+        def copy (num) :
+            new = ast.add(self.strings[self.kind[num]], self.start[num], self.end[num])
+            if self.src[num] >= 0 :
+                ast.src[new] = ast.string(self.strings[self.src[num]])
+            first = self.first[num]
+            children = [(copy(self.links[l]),
+                         None if self.fields[l] < 0 else self.strings[self.fields[l]])
+                        for l in range(first, first + self.count[num])]
+            if children :
+                ast.link(new, children)
+            return new
+        copy(root)
+        return ast
+    def children (self, num) :
+        "numbers of the anonymous children of node `num`"
+        first = self.first[num]
+        return [self.links[l] for l in range(first, first + self.count[num])
+                if self.fields[l] < 0]
+    def node (self, num) :
+        "view on node `num`"
+        view = self._views.get(num, None)
+        if view is None :
+            view = self._views[num] = CompactNode(self, num)
+        return view
+    @property
+    def root (self) :
+        return self.node(0)
+
+class CompactNode (tree) :
+    """a read-only view on a node from a `CompactAST`
+
+    It behaves as the `tree` that would have been dumped for the same node,
+    but its content is computed upon access from the arrays of the AST.
+    """
+    __slots__ = ("_ast_", "_num_")
+    def __init__ (self, ast, num) :
+        super().__init__()
+        object.__setattr__(self, "_ast_", ast)
+        object.__setattr__(self, "_num_", num)
+    def _items (self) :
+        ast, num = self._ast_, self._num_
+        yield "kind", ast.strings[ast.kind[num]]
+        if ast.location :
+            yield "_range", (ast.start[num], ast.end[num])
+            yield "_path", ast.path
+        fields, children = {}, []
+        first = ast.first[num]
+        for l in range(first, first + ast.count[num]) :
+            if (f := ast.fields[l]) < 0 :
+                children.append(ast.node(ast.links[l]))
+            else :
+                fields[ast.strings[f]] = ast.node(ast.links[l])
+        yield from fields.items()
+        if children :
+            yield "children", children
+        if (s := ast.src[num]) >= 0 :
+            yield "src", ast.strings[s]
+    def __getitem__ (self, key) :
+        ast, num = self._ast_, self._num_
+        if key == "kind" :
+            return ast.strings[ast.kind[num]]
+        elif key == "src" and ast.src[num] >= 0 :
+            return ast.strings[ast.src[num]]
+        elif key == "_range" and ast.location :
+            return (ast.start[num], ast.end[num])
+        elif key == "_path" and ast.location :
+            return ast.path
+        elif key == "children" :
+            if children := ast.children(num) :
+                return [ast.node(c) for c in children]
+        elif isinstance(key, str) and key in ast._strings :
+            name = ast._strings[key]
+            first = ast.first[num]
+            for l in reversed(range(first, first + ast.count[num])) :
+                if ast.fields[l] == name :
+                    return ast.node(ast.links[l])
+        raise KeyError(key)
+    def get (self, key, default=None) :
+        try :
+            return self[key]
+        except KeyError :
+            return default
+    def __getattr__ (self, key) :
+        return self.get(key, None)
+    def __setattr__ (self, key, val) :
+        raise TypeError(f"{self.__class__.__name__} is read-only")
+    def __setitem__ (self, key, val) :
+        raise TypeError(f"{self.__class__.__name__} is read-only")
+    def __delitem__ (self, key) :
+        raise TypeError(f"{self.__class__.__name__} is read-only")
+    def __contains__ (self, key) :
+        try :
+            self[key]
+            return True
+        except KeyError :
+            return False
+    def __iter__ (self) :
+        return (key for key, _ in self._items())
+    def __len__ (self) :
+        return sum(1 for _ in self._items())
+    def keys (self) :
+        return dict(self._items()).keys()
+    def values (self) :
+        return dict(self._items()).values()
+    def items (self) :
+        return dict(self._items()).items()
+    def copy (self) :
+        return tree(self._items())
+    def __eq__ (self, other) :
+        if isinstance(other, CompactNode) and other._ast_ is self._ast_ :
+            return other._num_ == self._num_
+        elif isinstance(other, dict) :
+            return dict(self._items()) == other
+        return NotImplemented
+    def __ne__ (self, other) :
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+    __hash__ = None
+    def __repr__ (self) :
+        return repr(dict(self._items()))
+
 #
 # a single source file
 #
 
+def _shift (node, delta) :
+    "copy of dumped `node` moved by `delta` bytes (or `node` itself if `delta == 0`)"
+    if not delta :
+        return node
+    elif isinstance(node, list) :
+        return [_shift(child, delta) for child in node]
+    elif isinstance(node, dict) :
+        copy = node.__class__((key, _shift(val, delta)) for key, val in node.items())
+        if "_range" in copy :
+            start, end = copy["_range"]
+            copy["_range"] = (start + delta, end + delta)
+        return copy
+    else :
+        return node
+
 class SourceFile (object) :
     LANG = "c"
     DUMP_IGNORE = (set("{}()[],;*\"'=\n")
@@ -28,39 +239,70 @@ class SourceFile (object) :
     # parsing
     #
     _language = {}
-    _tsparser = {}
+    _tsparser = threading.local()
+    _tslock = threading.Lock()
     @classmethod
-    def parse (cls, src, path=None, clean=True, ellipsis=None, location=True) :
+    def parse (cls, src, path=None, clean=True, ellipsis=None, location=True,
+               compact=False) :
         parser = cls._mkparser()
         if isinstance(src, str) :
             src = src.encode(**encoding)
-        return cls(src, path, parser.parse(src), clean, ellipsis, location)
+        return cls(src, path, parser.parse(src), clean, ellipsis, location, compact)
     @classmethod
-    def parse_file (cls, path, clean=True, ellipsis=None, location=True) :
+    def parse_file (cls, path, clean=True, ellipsis=None, location=True,
+                    compact=False) :
         path = Path(path)
-        return cls.parse(path.read_bytes(), path, clean, ellipsis, location)
+        return cls.parse(path.read_bytes(), path, clean, ellipsis, location, compact)
     @classmethod
     def _mkparser (cls) :
-        if cls.LANG not in cls._language :
-            sopath = Path(badass.lang.__file__).parent / "tslib.so"
-            cls._language[cls.LANG] = Language(sopath, cls.LANG)
-        if cls.LANG not in cls._tsparser :
-            cls._tsparser[cls.LANG] = TSParser()
-            cls._tsparser[cls.LANG].set_language(cls._language[cls.LANG])
-        return cls._tsparser[cls.LANG]
+        # TreeSitter parsers cannot be shared across threads, so we have one per
+        # thread, all using the same language
+        with cls._tslock :
+            if cls.LANG not in cls._language :
+                sopath = Path(badass.lang.__file__).parent / "tslib.so"
+                cls._language[cls.LANG] = Language(sopath, cls.LANG)
+        parser = getattr(cls._tsparser, cls.LANG, None)
+        if parser is None :
+            parser = TSParser()
+            parser.set_language(cls._language[cls.LANG])
+            setattr(cls._tsparser, cls.LANG, parser)
+        return parser
     #
     # source file
     #
     def __init__ (self, src, path, tree,
-                  clean=True, ellipsis=None, location=True) :
+                  clean=True, ellipsis=None, location=True, compact=False) :
         self.src = src
         self.path = None if path is None else Path(path)
         self.clean = clean
         self.ellipsis = ellipsis
         self.location= location
-        self.ast = self._dump_node(tree.root_node)
-    def _dump_node (self, node) :
+        self.compact = compact
+        if compact and ellipsis :
+            raise ValueError("compact AST does not support ellipsis")
+        self.tstree = tree
+        self._ast = None
+        self._batch = None
+    @property
+    def ast (self) :
+        "AST dumped from the TreeSitter tree upon first access"
+        if self._ast is None :
+            self._ast = self._dump(self.tstree)
+        return self._ast
+    def _dump (self, tree, reuse=None) :
+        if self.compact :
+            ast = CompactAST(self.path, self.location)
+            root = self._compact_node(tree.root_node, ast)
+            if ast.orphans :
+                ast = ast.pack(root)
+            return ast.root
+        else :
+            return self._dump_node(tree.root_node, reuse)
+    def _dump_node (self, node, reuse=None) :
         "dump TreeSitter node a as tree"
+        if (reuse and not node.has_error
+            and (old := reuse.pop((node.type, node.start_byte, node.end_byte), None))) :
+            return old
         dump = tree(kind=node.type)
         if self.location :
             dump["_range"] = (node.start_byte, node.end_byte)
@@ -73,9 +315,9 @@ class SourceFile (object) :
                 name = cursor.current_field_name()
                 if name is not None :
                     src = False
-                    dump[name] = self._dump_node(cursor.node)
+                    dump[name] = self._dump_node(cursor.node, reuse)
                 elif (cursor.node.type == "ERROR"
-                      and (sub := self._dump_node(cursor.node))
+                      and (sub := self._dump_node(cursor.node, reuse))
                       and len(sub.get("children", [])) == 1) :
                     return sub["children"][0]
                 elif (self.ellipsis and cursor.node.type == "ERROR"
@@ -84,7 +326,7 @@ class SourceFile (object) :
                 elif ((ct := cursor.node.type)
                       and ct not in self.DUMP_IGNORE
                       and not (self.clean and ct in self.DUMP_CLEAN)) :
-                    children.append(self._dump_node(cursor.node))
+                    children.append(self._dump_node(cursor.node, reuse))
                 if not cursor.goto_next_sibling() :
                     break
             if children :
@@ -97,6 +339,37 @@ class SourceFile (object) :
             if txt != dump.kind :
                 dump["src"] = txt
         return dump
+    def _compact_node (self, node, ast) :
+        "dump TreeSitter node into a CompactAST, return its number"
+        num = ast.add(node.type, node.start_byte, node.end_byte)
+        cursor = node.walk()
+        children = []
+        if cursor.goto_first_child() :
+            while True :
+                name = cursor.current_field_name()
+                ct = cursor.node.type
+                if name is not None :
+                    children.append((self._compact_node(cursor.node, ast), name))
+                elif ct == "ERROR" :
+                    sub = self._compact_node(cursor.node, ast)
+                    if len(sub_children := ast.children(sub)) == 1 :
+                        # node and ERROR wrapper are left unreachable
+                        ast.orphans = True
+                        return sub_children[0]
+                    elif self.clean :
+                        ast.orphans = True
+                    else :
+                        children.append((sub, None))
+                elif (ct and ct not in self.DUMP_IGNORE
+                      and not (self.clean and ct in self.DUMP_CLEAN)) :
+                    children.append((self._compact_node(cursor.node, ast), None))
+                if not cursor.goto_next_sibling() :
+                    break
+        if children :
+            ast.link(num, children)
+        elif (txt := self[node]) != node.type :
+            ast.src[num] = ast.string(txt)
+        return num
     def __str__ (self) :
         return ast2str(self.ast, f"{F.MAGENTA}{self.path or '<STRING>'}{F.RESET}")
     def _get_range (self, obj) :
@@ -115,31 +388,126 @@ class SourceFile (object) :
     def __delitem__ (self, obj) :
         "delete source code for a node"
         start_byte, end_byte = self._get_range(obj)
-        src = self.src[:start_byte] + self.src[end_byte:]
-        self._update(src)
+        self._edit(start_byte, end_byte, b"")
     def __setitem__ (self, obj, src) :
         "replace source code for a node"
         start_byte, end_byte = self._get_range(obj)
         if isinstance(src, str) :
             src = src.encode(**encoding)
-        src = self.src[:start_byte] + src + self.src[end_byte:]
-        self._update(src)
+        self._edit(start_byte, end_byte, src)
     def comment (self, obj, start, end="") :
         "comment source code for a node"
         start_byte, end_byte = self._get_range(obj)
-        chunks = [self.src[:start_byte].decode(**encoding)]
+        chunks = []
         for line in self[start_byte, end_byte].splitlines(keepends=True) :
             head = line.rstrip()
             tail = line[len(head):]
             chunks.append(f"{start}{head}{end}{tail}")
-        chunks.append(self.src[end_byte:].decode(**encoding))
-        self._update("".join(chunks).encode(**encoding))
-    def _update (self, src) :
+        self._edit(start_byte, end_byte, "".join(chunks).encode(**encoding))
+    @contextlib.contextmanager
+    def batch (self) :
+        """delay the edits made within a `with` block and apply them at once
+
+        Ranges passed to edits within the block refer to the source as it was
+        when the block was entered. Edits are dropped if an exception occurs.
+        """
+        if self._batch is not None :
+            yield self
+            return
+        self._batch = []
+        try :
+            yield self
+        finally :
+            edits, self._batch = self._batch, None
+        if edits :
+            self._update(edits)
+    def _edit (self, start_byte, end_byte, src) :
+        if self._batch is not None :
+            self._batch.append((start_byte, end_byte, src))
+        else :
+            self._update([(start_byte, end_byte, src)])
+    def _point (self, pos, src=b"") :
+        "(row, column) at byte pos of the source, or at the end of src inserted there"
+        row = self.src.count(b"\n", 0, pos)
+        col = pos - self.src.rfind(b"\n", 0, pos) - 1
+        if (lines := src.count(b"\n")) :
+            return row + lines, len(src) - src.rfind(b"\n") - 1
+        else :
+            return row, col + len(src)
+    def _update (self, edits) :
+        "apply edits (start_byte, end_byte, src), reparse and redump incrementally"
+        edits = sorted(edits, key=lambda e : e[:2])
+        for (_, end, _), (start, _, _) in zip(edits, edits[1:]) :
+            if start < end :
+                raise ValueError("overlapping edits")
+        chunks, pos = [], 0
+        for start_byte, end_byte, src in edits :
+            chunks.extend([self.src[pos:start_byte], src])
+            pos = end_byte
+        chunks.append(self.src[pos:])
+        src = b"".join(chunks)
         if self.path :
             self.path.write_bytes(src)
-        new = self.parse(src, self.path, self.clean, self.ellipsis, self.location)
+        # last edit first so that the positions of the previous ones stay valid
+        for start_byte, end_byte, new in reversed(edits) :
+            self.tstree.edit(start_byte=start_byte,
+                             old_end_byte=end_byte,
+                             new_end_byte=start_byte + len(new),
+                             start_point=self._point(start_byte),
+                             old_end_point=self._point(end_byte),
+                             new_end_point=self._point(start_byte, new))
+        new = self._mkparser().parse(src, self.tstree)
+        if self._ast is not None and self.location and not self.compact :
+            reuse = self._reusable(edits, self.tstree.get_changed_ranges(new))
+        else :
+            reuse = None
         self.src = src
-        self.ast = new.ast
+        self.tstree = new
+        if reuse is None :
+            # dumped from the new tree upon next access
+            self._ast = None
+        else :
+            self._ast = self._dump(new, reuse)
+    def _reusable (self, edits, changed) :
+        """dumped nodes that are not impacted by edits
+
+        Reusable nodes are returned as a dict that maps `(kind, start, end)` to
+        each topmost such node, copied with its `_range` updated to match the
+        edited source if it has moved, so that the previous dump is left
+        unchanged.
+        """
+        ends = [end_byte for _, end_byte, _ in edits]
+        shift = [0]
+        spans = [(r.start_byte, r.end_byte) for r in changed]
+        for start_byte, end_byte, src in edits :
+            start = start_byte + shift[-1]
+            spans.append((start, start + len(src)))
+            shift.append(shift[-1] + len(src) - end_byte + start_byte)
+        def _changed (start, end) :
+            return any((start < e and s < end) or (s == e and start < s < end)
+                       for s, e in spans)
+        reuse = {}
+        todo = [self._ast]
+        while todo :
+            node = todo.pop()
+            if isinstance(node, list) :
+                todo.extend(node)
+                continue
+            elif not isinstance(node, dict) or "_range" not in node :
+                continue
+            start, end = node["_range"]
+            num = bisect_right(ends, start)
+            if num < len(edits) and edits[num][0] < end :
+                todo.extend(node.values())
+                continue
+            start, end = start + shift[num], end + shift[num]
+            if _changed(start, end) :
+                todo.extend(node.values())
+                continue
+            key = (node["kind"], start, end)
+            # a node with the same kind and range may be ambiguous
+            reuse[key] = None if key in reuse else _shift(node, shift[num])
+        return reuse
 
 #
 # a collection of source files
@@ -153,9 +521,11 @@ class SourceTree (object) :
     #
     # content management
     #
-    def __init__ (self, root) :
+    def __init__ (self, root, compact=False, jobs=None) :
         self.root = Path(root)
+        self.compact = compact
         self.src = {}
+        paths = []
         todo = [self.root]
         while todo :
             path = todo.pop()
@@ -164,15 +534,21 @@ class SourceTree (object) :
                     if child.is_dir() :
                         todo.append(child)
                     else :
-                        self.add_path(child)
+                        paths.append(child)
+        # files are parsed concurrently but added in a deterministic order
+        paths.sort()
+        with ThreadPoolExecutor(jobs) as pool :
+            for path, sf in zip(paths, pool.map(self._parse_path, paths)) :
+                self.src[path] = sf
     def __repr__ (self) :
         return f"<SourceTree {self.root}:{len(self.src)}>"
     def __str__ (self) :
         return ast2str({f"{F.MAGENTA}{p}{F.RESET}" : s.ast for p, s in self.src.items()} ,
                        f"{F.MAGENTA}{self.root}{F.WHITE}/...{F.RESET}")
+    def _parse_path (self, path) :
+        return SourceFile.parse_file(path, compact=self.compact)
     def add_path (self, path) :
-        sf = SourceFile.parse_file(path)
-        self.src[path] = sf
+        self.src[path] = self._parse_path(path)
     def add_source (self, src, path) :
         if isinstance(src, str) :
             src = src.encode(**encoding)
@@ -181,26 +557,36 @@ class SourceTree (object) :
             out.write(src)
         self.add_path(path)
     def __getitem__ (self, ast) :
-        if isinstance(ast, Iterable) :
+        if isinstance(ast, Iterable) and not isinstance(ast, dict) :
             return [self.src[a._path][a] for a in ast]
         else :
             return self.src[ast._path][ast]
     def __setitem__ (self, ast, src) :
-        if isinstance(ast, Iterable) :
-            for a, s in zip(ast, src) :
-                self.src[a._path][a] = s
+        if isinstance(ast, Iterable) and not isinstance(ast, dict) :
+            with self.batch() :
+                for a, s in zip(ast, src) :
+                    self.src[a._path][a] = s
         else :
             self.src[ast._path][ast] = src
     def __delitem__ (self, ast) :
-        if not isinstance(ast, Iterable) :
+        if not isinstance(ast, Iterable) or isinstance(ast, dict) :
             ast = [ast]
-        for a in ast :
-            del self.src[a._path][a]
+        with self.batch() :
+            for a in ast :
+                del self.src[a._path][a]
     def comment (self, ast) :
-        if not isinstance(ast, Iterable) :
+        if not isinstance(ast, Iterable) or isinstance(ast, dict) :
             ast = [ast]
-        for a in ast :
-            self.src[a._path].comment(a, *self.COMMENT)
+        with self.batch() :
+            for a in ast :
+                self.src[a._path].comment(a, *self.COMMENT)
+    @contextlib.contextmanager
+    def batch (self) :
+        "delay the edits made within a `with` block and apply them at once"
+        with contextlib.ExitStack() as stack :
+            for sf in self.src.values() :
+                stack.enter_context(sf.batch())
+            yield self
     #
     # patterns and queries
     #
@@ -226,10 +612,18 @@ class SourceTree (object) :
     @property
     def Q (self) :
         """a query object that matches all the AST in the source tree"""
-        return Q([st.ast for st in self.src.values()])
-    def match (self, first, *others, debug=0, ellipsis="...") :
+        return self.query()
+    def query (self, glob=None) :
+        """a query object that matches the AST of the source files in the tree
+
+        If `glob` is given, only the files whose path relative to the root of the
+        tree matches it are considered, and the AST of the others are not dumped.
+        """
+        return Q([sf.ast for path, sf in self.src.items()
+                  if glob is None or path.relative_to(self.root).match(glob)])
+    def match (self, first, *others, debug=0, ellipsis="...", glob=None) :
         last = len(others)
-        prev = self.Q
+        prev = self.query(glob)
         for num, pat in enumerate((first,) + others) :
             if isinstance(pat, str) :
                 pat = self.compile_pattern(pat, ellipsis)
@@ -1,7 +1,5 @@
-import sys, tempfile, io, re
+import sys, tempfile, io, re, os, json, hashlib, multiprocessing
 
-from functools import reduce
-from operator import or_
 from pathlib import Path
 from collections import namedtuple, defaultdict
 from zipfile import ZipFile, ZIP_STORED, ZIP_LZMA
@@ -11,6 +9,7 @@ from werkzeug.utils import secure_filename
 
 from .. import encoding, chmod_r, tree
 from ..db import connect
+from ..db.blobs import manifest, MANIFEST
 
 class Test (object) :
     _TEST = {"pass" : 0,
@@ -52,6 +51,12 @@ class Test (object) :
             nodes[dot.rsplit(".", 1)[0]].children.append(nodes[dot])
             if row["auto"] != "True" :
                 names[num] = row["text"]
+        cls.add_names(names)
+        root.names = names
+        root.status = cls._STAT[max(c.val for c in root.children)]
+        return root
+    @classmethod
+    def add_names (cls, names) :
         if not cls.NAMES :
             cls.NAMES.update(names)
         else :
@@ -60,8 +65,6 @@ class Test (object) :
                     del cls.NAMES[num]
                 else :
                     cls.NAMES[num] = cls._prefix(cls.NAMES[num], names[num])
-        root.status = cls._STAT[max(c.val for c in root.children)]
-        return root
     @classmethod
     def reset (cls) :
         cls.NAMES.clear()
@@ -106,17 +109,28 @@ class _DB (object) :
         for ex in exercises :
             c, e = ex.split("/", 1)
             self.exercises[c].add(e)
+        # all the submissions are fetched at once and grouped by exercise
+        self.rows = defaultdict(list)
+        if not (groups and self.exercises) :
+            return
+        users, submissions = self.DB.users, self.DB.submissions
+        dbfilter = ((users.id == submissions.user)
+                    & users.group.belongs(set(groups))
+                    & submissions.course.belongs(set(self.exercises))
+                    & submissions.exercise.belongs(set().union(*self.exercises.values())))
+        for row in self.DB(dbfilter).select(users.firstname,
+                                            users.lastname,
+                                            users.studentid,
+                                            users.group,
+                                            submissions.date,
+                                            submissions.course,
+                                            submissions.exercise,
+                                            submissions.path) :
+            c, e = row.submissions.course, row.submissions.exercise
+            if e in self.exercises[c] :
+                self.rows[c, e].append(row)
     def submissions (self, course, exercise) :
-        dbfilter = ((self.DB.users.id == self.DB.submissions.user)
-                    & reduce(or_, (self.DB.users.group == g for g in self.groups))
-                    & (self.DB.submissions.exercise == exercise)
-                    & (self.DB.submissions.course == course))
-        yield from self.DB(dbfilter).select(self.DB.users.firstname,
-                                            self.DB.users.lastname,
-                                            self.DB.users.studentid,
-                                            self.DB.users.group,
-                                            self.DB.submissions.date,
-                                            self.DB.submissions.path)
+        yield from self.rows.get((course, exercise), [])
 
 class _CSV (object) :
     tables = {"users" : {"studentid", "firstname", "lastname", "group"},
@@ -127,7 +141,7 @@ class _CSV (object) :
         for ex in exercises :
             c, e = ex.split("/", 1)
             self.exercises[c].add(e)
-        self.rows = []
+        self.rows = defaultdict(list)
         c2t = {}
         for table, cols in self.tables.items() :
             c2t.update((c, table) for c in cols)
@@ -149,68 +163,173 @@ class _CSV (object) :
                         continue
                 else :
                     self.exercises[c].add(e)
-                self.rows.append(root)
+                self.rows[c, e].append(root)
     def submissions (self, course, exercise) :
-        for row in self.rows :
-            if (row.submissions.course == course
-                and row.submissions.exercise == exercise) :
-                yield row
+        yield from self.rows.get((course, exercise), [])
+
+_report = None
+
+def _init (report) :
+    global _report
+    _report = report
+
+def _sheet (exercise) :
+    return _report._sheet(*exercise)
 
 class Report (object) :
+    # cache files stored in submissions directories
+    SCORE = ".score.json"
+    BUNDLE = ".bundle.zip"
+    # written by `badass run` as tests complete
+    PROGRESS = "progress.jsonl"
     @classmethod
-    def from_db (cls, dbpath, groups, exercises) :
+    def from_db (cls, dbpath, groups, exercises, files="copy", jobs=None) :
         db = _DB(dbpath, groups, exercises)
-        return cls(db)
+        return cls(db, files, jobs)
     @classmethod
-    def from_csv (cls, csvpath, groups, exercises) :
+    def from_csv (cls, csvpath, groups, exercises, files="copy", jobs=None) :
         db = _CSV(csvpath, groups, exercises)
-        return cls(db)
-    def __init__ (self, db) :
+        return cls(db, files, jobs)
+    def __init__ (self, db, files="copy", jobs=None) :
         # only load if necessary to speedup prog startup
-        global Workbook, dataframe_to_rows, PatternFill, Alignment
+        global Workbook, WriteOnlyCell, NamedStyle, Alignment, get_column_letter
+        global builtin_styles
         from openpyxl import Workbook
-        from openpyxl.styles import PatternFill, Alignment
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import NamedStyle, Alignment
+        from openpyxl.styles.builtins import styles as builtin_styles
+        from openpyxl.utils import get_column_letter
         #
+        self.db = db
+        self.files = files
         self.xlsx_init()
-        self.content = {}
-        for c, exos in db.exercises.items() :
-            for e in sorted(exos) :
-                Test.reset()
+        self.content = []
+        exercises = [(c, e) for c, exos in db.exercises.items()
+                     for e in sorted(exos)]
+        # sheets data is collected in parallel by forked workers, and sheets
+        # are then written in order as their data is available
+        jobs = min(jobs or os.cpu_count() or 1, len(exercises))
+        if jobs <= 1 :
+            sheets = (self._sheet(c, e) for c, e in exercises)
+            pool = None
+        else :
+            ctx = multiprocessing.get_context("fork")
+            pool = ctx.Pool(jobs, _init, (self,))
+            sheets = pool.imap(_sheet, exercises)
+        try :
+            for (c, e), (rows, best, names, content) in zip(exercises, sheets) :
                 self.xlsx_new_ws(f"{c}-{e}")
-                for row in db.submissions(c, e) :
-                    self.xlsx_add_row(row)
-                    root = Path(row.submissions.path)
-                    name = f"{row.users.lastname} {row.users.firstname}".title()
-                    head = Path(secure_filename(name), *root.parts[1:])
-                    chmod_r(root)
-                    self.content.update(self._walk(root, head, root))
+                self.rows, self.best = rows, best
+                Test.reset()
+                Test.NAMES.update(names)
+                self.content.extend(content)
                 self.xlsx_done_ws()
-    def _walk (self, root, head, sub) :
+        finally :
+            if pool is not None :
+                pool.close()
+                pool.join()
+    def _sheet (self, course, exercise) :
+        # collect the data for one sheet without touching the workbook
+        Test.reset()
+        self.rows, self.best, content = [], {}, []
+        for row in self.db.submissions(course, exercise) :
+            self.xlsx_add_row(row)
+            root = Path(row.submissions.path)
+            name = f"{row.users.lastname} {row.users.firstname}".title()
+            head = Path(secure_filename(name), *root.parts[1:])
+            chmod_r(root)
+            if self.files == "none" :
+                continue
+            bundle = self._bundle(root) if self.files == "bundle" else None
+            if bundle is None :
+                content.extend(self._files(root, head))
+            else :
+                content.append((bundle, head.with_name(head.name + ".zip")))
+        return self.rows, self.best, dict(Test.NAMES), content
+    def _files (self, root, head) :
+        # stored files are read from their blobs, and their directories are not
+        # walked, as listed in the manifest of the submission
+        files, dirs = manifest(root) or ({}, set())
+        for name, blob in files.items() :
+            yield blob, head / name
+        skip = {root / d for d in dirs}
+        for path, name in self._walk(root, head, root, skip) :
+            if str(path.relative_to(root)) not in files :
+                yield path, name
+    def _walk (self, root, head, sub, skip=set()) :
         if sub.is_dir() :
             for path in sub.iterdir() :
                 if path.is_file() :
+                    if sub == root and path.name in (self.SCORE, self.BUNDLE,
+                                                     self.PROGRESS, MANIFEST) :
+                        continue
                     yield path, head / path.relative_to(root)
-                elif path.is_dir() :
-                    yield from self._walk(root, head, path)
+                elif path.is_dir() and path not in skip :
+                    yield from self._walk(root, head, path, skip)
+    def _bundle (self, root) :
+        # zip the files of a submission once, and reuse this zip while they are
+        # unchanged, its comment identifies the files it was built from
+        files = sorted(self._files(root, Path()), key=lambda f: str(f[1]))
+        stats = [(str(name), path.stat()) for path, name in files]
+        key = hashlib.sha1(repr([(n, s.st_mtime_ns, s.st_size)
+                                 for n, s in stats]).encode()).hexdigest()
+        bundle = root / self.BUNDLE
+        try :
+            with ZipFile(bundle) as zf :
+                if zf.comment.decode() == key :
+                    return bundle
+        except Exception :
+            pass
+        try :
+            fd, tmp = tempfile.mkstemp(dir=root, prefix=self.BUNDLE, suffix=".tmp")
+            with os.fdopen(fd, "wb") as out, \
+                 ZipFile(out, "w", compression=ZIP_STORED) as zf :
+                for path, name in files :
+                    # blobs have no suffix, so the name is checked instead
+                    if name.suffix == ".zip" :
+                        zf.write(path, name)
+                    else :
+                        zf.write(path, name,
+                                 compress_type=ZIP_LZMA, compresslevel=9)
+                zf.comment = key.encode()
+            os.replace(tmp, bundle)
+        except OSError :
+            # cannot write into submission directory
+            return None
+        return bundle
+    def save_listing (self, path) :
+        """save the spreadsheet next to `path` and the list of files to be
+        archived with it into `path`, to build the archive only when needed"""
+        path = Path(path)
+        xlsx = path.with_suffix(".xlsx")
+        with xlsx.open("wb") as out :
+            self.wb.save(out)
+        content = [[str(xlsx.absolute()), "report.xlsx"]]
+        content.extend([str(cont.absolute()), str(name)]
+                       for cont, name in self.content)
+        with path.open("w", **encoding) as out :
+            json.dump(content, out)
     def save (self, path) :
         with ZipFile(path, "w", compression=ZIP_STORED) as zf :
-            zf.writestr("report.xlsx", self.xlsx_data(),
-                        compress_type=ZIP_LZMA, compresslevel=9)
-            for cont, name in self.content.items() :
-                if cont.suffix == ".zip" :
+            # xlsx is already compressed, it is streamed into zf as is
+            with zf.open("report.xlsx", "w", force_zip64=True) as out :
+                self.wb.save(out)
+            for cont, name in self.content :
+                if name.suffix == ".zip" :
                     comp = {}
                 else :
                     comp = {"compress_type" : ZIP_LZMA,
                             "compresslevel" : 9}
                 zf.write(cont, name, **comp)
     def xlsx_init (self) :
-        self.wb = Workbook()
-        self.wb.remove(self.wb.active)
-    def xlsx_data (self) :
-        with tempfile.NamedTemporaryFile(mode="w+b", suffix=".xlsx") as tmp :
-            self.wb.save(tmp.name)
-            tmp.seek(0)
-            return tmp.read()
+        # sheets are streamed, cells cannot be changed once written
+        self.wb = Workbook(write_only=True)
+        note = builtin_styles["Note"]
+        self.wb.add_named_style(NamedStyle(self._HEAD_STYLE,
+                                           font=note.font,
+                                           fill=note.fill,
+                                           border=note.border,
+                                           alignment=Alignment(textRotation=90)))
     _sheetname = re.compile("-*[^a-z0-9-]+-*", re.I)
     def xlsx_new_ws (self, name) :
         name = self._sheetname.sub("-", name)
@@ -223,8 +342,7 @@ class Report (object) :
         path = Path(row.submissions.path)
         report = path / "report.zip"
         try :
-            with ZipFile(report) as zf :
-                test_data = io.StringIO(zf.read("report.csv").decode(**encoding))
+            score, marks = self._score(path, report)
         except :
             self.rows.append([row.users.studentid,
                               name,
@@ -233,12 +351,10 @@ class Report (object) :
                               False,
                               row.submissions.date])
             return
-        test = Test.from_csv(test_data)
         try :
             permalink = (path / "permalink").read_text(**encoding)
         except :
             permalink = "missing"
-        score = 1 - test.value()
         self.best[row.users.studentid] = max(score,
                                              self.best.get(row.users.studentid, 0))
         self.rows.append([row.users.studentid,
@@ -248,14 +364,42 @@ class Report (object) :
                           False,
                           row.submissions.date,
                           permalink,
-                          dict(test)])
-    def _xlsx_add_row (self, row, values, styles=None, formats=None) :
+                          marks])
+    def _score (self, path, report) :
+        # scores are cached along with the report they are computed from, the
+        # cache being valid as long as report is not modified
+        stat = report.stat()
+        key = [stat.st_mtime_ns, stat.st_size]
+        cache = path / self.SCORE
+        try :
+            data = json.loads(cache.read_text(**encoding))
+            if data["key"] == key :
+                Test.add_names(data["names"])
+                return data["score"], data["marks"]
+        except Exception :
+            pass
+        with ZipFile(report) as zf :
+            test_data = io.StringIO(zf.read("report.csv").decode(**encoding))
+        test = Test.from_csv(test_data)
+        data = {"key" : key,
+                "names" : test.names,
+                "score" : 1 - test.value(),
+                "marks" : dict(test)}
+        try :
+            with cache.open("w", **encoding) as out :
+                json.dump(data, out)
+        except OSError :
+            pass
+        return data["score"], data["marks"]
+    def _xlsx_add_row (self, values, styles=None, formats=None) :
         if not isinstance(styles, (list, tuple)) :
             styles = [styles] * len(values)
         if not isinstance(formats, (list, tuple)) :
             formats = [formats] * len(values)
-        for col, (val, sty, fmt) in enumerate(zip(values, styles, formats), 1) :
-            cell = self.ws.cell(column=col, row=row, value=val)
+        cells = []
+        for val, sty, fmt in zip(values, styles, formats) :
+            cell = WriteOnlyCell(self.ws, value=val)
+            cells.append(cell)
             if callable(sty) :
                 sty(cell)
             elif sty is not None :
@@ -264,17 +408,25 @@ class Report (object) :
                 fmt(cell)
             elif fmt is not None :
                 cell.number_format = fmt
+        self.ws.append(cells)
     def xlsx_done_ws (self) :
         self.rows.sort(key=lambda row: (row[0], row[5]))
         # write headers
         tests = list(Test.headers())
         self.headers.extend(f"{num}. {txt}" for num, txt in tests)
-        self._xlsx_add_row(1, self.headers, styles=self._xlsx_style_head)
-        # additional headers style
+        # sheet layout must be set before rows are written
+        for col, hdr in enumerate(self.headers, 1) :
+            width = self._HEAD_WIDTH.get(hdr, 3)
+            self.ws.column_dimensions[get_column_letter(col)].width = width
         self.ws.row_dimensions[1].height = 200
-        self.ws.auto_filter.ref = self.ws.dimensions
+        self.ws.auto_filter.ref = (f"A1:{get_column_letter(len(self.headers))}"
+                                   f"{len(self.rows) + 1}")
+        self._xlsx_add_row(self.headers,
+                           styles=["Note" if hdr in self._HEAD_WIDTH
+                                   else self._HEAD_STYLE
+                                   for hdr in self.headers])
         # write rows
-        for num, row in enumerate(self.rows, 2) :
+        for row in self.rows :
             if row[3] == "CRASH" :
                 styles = "Bad"
                 formats = [None, None, None, None,
@@ -296,7 +448,9 @@ class Report (object) :
                            for hdr in self.headers]
                 test = row.pop(-1)
                 row.extend(test[num] for num, _ in tests)
-            self._xlsx_add_row(num, row, styles=styles, formats=formats)
+            self._xlsx_add_row(row, styles=styles, formats=formats)
+        self.ws.close()
+        self.rows = []
     _HEAD_WIDTH = {"student" : 12,
                    "name" : 16,
                    "group" : 8,
@@ -304,19 +458,14 @@ class Report (object) :
                    "best" : 8,
                    "date" : 12,
                    "report" : 8}
-    def _xlsx_style_head (self, cell) :
-        cell.style = "Note"
-        if cell.value not in self._HEAD_WIDTH :
-            cell.alignment = Alignment(textRotation=90)
-        width = self._HEAD_WIDTH.get(cell.value, 3)
-        self.ws.column_dimensions[cell.column_letter].width = width
+    _HEAD_STYLE = "Note Rotated"
+    _MARK_STYLE = {0 : "Good",
+                   1 : "Neutral",
+                   2 : "Bad"}
     def _xlsx_style_mark (self, cell) :
-        if cell.value == 0 :
-            cell.style = "Good"
-        elif cell.value == 1 :
-            cell.style = "Neutral"
-        elif cell.value == 2 :
-            cell.style = "Bad"
+        style = self._MARK_STYLE.get(cell.value, None)
+        if style is not None :
+            cell.style = style
     def _xlsx_format_score (self, cell) :
         cell.number_format = "0%"
     def _xlsx_format_best (self, cell) :
@@ -4,7 +4,9 @@ from . import Report
 
 def add_arguments (sub) :
     sub.add_argument("-o", "--output", metavar="PATH", type=str, required=True,
-                     help="target path of report file")
+                     help="target path of report file (with suffix '.json',"
+                     " only save the spreadsheet and the list of files to be"
+                     " archived with it)")
     mutex = sub.add_mutually_exclusive_group(required=True)
     mutex.add_argument("-c", "--csv", metavar="PATH", type=str, default=None,
                        help="fetch info from CSV in file PATH")
@@ -14,15 +16,29 @@ def add_arguments (sub) :
                      help="groups to be included into the report")
     sub.add_argument("-e", "--exos", default=[], nargs="+",
                      help="COURSE/EXERCISE to be included into the report")
+    sub.add_argument("-f", "--files", default="copy",
+                     choices=["copy", "bundle", "none"],
+                     help="how submitted files are included: copied one by one,"
+                     " as one (cached) zip per submission, or not at all"
+                     " (default: copy)")
+    sub.add_argument("-j", "--jobs", type=int, default=None,
+                     help="number of exercises processed in parallel"
+                     " (default: number of CPUs)")
 
 def main (args) :
     "build report from submitted projects"
     if args.database :
-        rep = Report.from_db(args.database, args.groups, args.exos)
+        rep = Report.from_db(args.database, args.groups, args.exos, args.files,
+                             args.jobs)
     elif args.csv :
-        rep = Report.from_csv(args.csv, args.groups, args.exos)
+        rep = Report.from_csv(args.csv, args.groups, args.exos, args.files,
+                              args.jobs)
     else :
         print("error: use either --database or --csv",
               file=sys.stderr)
         sys.exit(2)
-    rep.save(Path(args.output))
+    output = Path(args.output)
+    if output.suffix == ".json" :
+        rep.save_listing(output)
+    else :
+        rep.save(output)
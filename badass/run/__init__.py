@@ -9,7 +9,7 @@ from tempfile import mkstemp
 from subprocess import run as subprocess_run, PIPE, STDOUT
 
 from ..lang import load as load_lang
-from .. import tree, encoding, cached_property, JSONEncoder, mdesc, chmod_r
+from .. import tree, encoding, cached_property, JSONEncoder, mdesc, chmod_r, md
 from .queries import query, expand, TQL
 from .report import Report
 
@@ -29,11 +29,21 @@ from IPython.core import ultratb
 CONFIG = tree()
 ARGS = tree()
 
+# events are appended to this file in the project directory as the assessment
+# progresses, so that they can be followed while it runs
+PROGRESS = "progress.jsonl"
+
 ##
 ##
 ##
 
 
+def progress(event, **data):
+    "record `event` with its `data` in the progress file of the current project"
+    with (Path(CONFIG.project) / PROGRESS).open("a", **encoding) as out:
+        out.write(json.dumps(dict(data, event=event), cls=JSONEncoder) + "\n")
+
+
 def debug(e, c, t):
     if CONFIG.debug:
         vtb = ultratb.VerboseTB(color_scheme="Linux")
@@ -249,6 +259,7 @@ class Test(_Test):
         self.repo = Repository(self.test_dir)
         if self.NUM == 1:
             self.lang.cleanup(self.project_dir / "src", self.project_dir / "itw")
+            (self.project_dir / PROGRESS).unlink(missing_ok=True)
 
     def __enter__(self):
         copytree(self.project_dir / "src", self.test_dir / "src", dirs_exist_ok=True)
@@ -275,6 +286,9 @@ class Test(_Test):
             chmod_r(self.test_dir)
             rmtree(self.test_dir, ignore_errors=True)
         self.TESTS.append(test_zip)
+        progress(
+            "test", test=self.num, status=str(self.status).lower(), text=md(self.text)
+        )
         return True
 
     def add_source(self, source):
@@ -593,3 +607,20 @@ class Run(_AllTest):
 def report():
     rep = Report(Path(CONFIG.project), Test.TESTS)
     rep.save()
+    progress("done", tests=len(Test.TESTS))
+
+
+def evaluate(script, project, code=None):
+    """run assessment `script` against `project` and save its report
+
+    `code` may be `script` already compiled, so that it is not parsed again
+    when the same script is evaluated against many projects.
+    """
+    if code is None:
+        with open(script, **encoding) as src:
+            code = compile(src.read(), str(script), "exec")
+    CONFIG.project = str(project)
+    Test.NUM = 0
+    Test.TESTS = []
+    exec(code, {"__name__": "<run_path>", "__file__": str(script)})
+    report()
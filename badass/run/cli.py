@@ -1,5 +1,6 @@
-import runpy, ast
+import runpy, ast, glob, os, sys, multiprocessing
 import badass.run
+import badass.lang
 
 def add_arguments (sub) :
     sub.add_argument("-k", "--keep", default=False, action="store_true",
@@ -13,16 +14,20 @@ def add_arguments (sub) :
                      help="print ignored exceptions")
     sub.add_argument("-s", "--summary", action="store_true", default=False,
                      help="summarise report on stdout")
+    sub.add_argument("-b", "--batch", action="store_true", default=False,
+                     help="run script against every project (paths or globs)")
+    sub.add_argument("-j", "--jobs", type=int, default=None,
+                     help="number of projects run in parallel in batch mode"
+                     " (default: number of CPUs)")
     sub.add_argument("script", type=str,
                      help="path to script")
-    sub.add_argument("project", type=str,
+    sub.add_argument("project", type=str, nargs="+",
                      help="path to project")
 
 def summary (path) :
     from zipfile import ZipFile
     from pathlib import Path
     from csv import DictReader
-    from sys import argv
     from io import TextIOWrapper
     from colorama import Style, Fore
     class tree (object) :
@@ -60,7 +65,7 @@ def summary (path) :
          ZipFile(zdata) as zf :
         infile = TextIOWrapper(zf.open("report.csv"), encoding="utf-8", errors="replace")
         report = list(DictReader(infile))
-    root = tree(Path(argv[-1]).stem)
+    root = tree(Path(path).stem)
     nodes = {"" : root}
     for test in report :
         num = f".{test['test']}"
@@ -69,6 +74,61 @@ def summary (path) :
         nodes[pid].children.append(nodes[num])
     root.print()
 
+def _projects (patterns) :
+    seen = set()
+    for pattern in patterns :
+        # a pattern that matches nothing is kept to be reported as an error
+        for path in sorted(glob.glob(pattern)) or [pattern] :
+            if path not in seen :
+                seen.add(path)
+                yield path
+
+_script = _code = None
+
+def _init (script, code) :
+    global _script, _code
+    _script, _code = script, code
+
+def _evaluate (project) :
+    try :
+        badass.run.evaluate(_script, project, _code)
+        return project, None
+    except Exception as err :
+        badass.run.debug(type(err), err, err.__traceback__)
+        return project, f"{err.__class__.__name__}: {err}"
+
+def batch (args) :
+    "run script against many projects, loading it only once"
+    # language and script are loaded before forking so that workers share them
+    badass.lang.load(args.lang)
+    with open(args.script, **badass.encoding) as src :
+        code = compile(src.read(), args.script, "exec")
+    projects = list(_projects(args.project))
+    jobs = min(args.jobs or os.cpu_count() or 1, len(projects))
+    if jobs <= 1 :
+        _init(args.script, code)
+        results = map(_evaluate, projects)
+        pool = None
+    else :
+        ctx = multiprocessing.get_context("fork")
+        pool = ctx.Pool(jobs, _init, (args.script, code))
+        results = pool.imap(_evaluate, projects)
+    failed = 0
+    try :
+        for project, error in results :
+            if error is None :
+                print(f"{project}: done")
+                if args.summary :
+                    summary(project)
+            else :
+                failed += 1
+                print(f"{project}: {error}", file=sys.stderr)
+    finally :
+        if pool is not None :
+            pool.close()
+            pool.join()
+    return 1 if failed else 0
+
 def main (args) :
     "run assessment script"
     badass.run.CONFIG.update(args)
@@ -81,7 +141,13 @@ def main (args) :
                 badass.run.ARGS[k] = v
         except :
             badass.run.ARGS[d] = True
+    if args.batch :
+        return batch(args)
+    elif len(args.project) > 1 :
+        print("error: use --batch to run several projects", file=sys.stderr)
+        return 1
+    badass.run.CONFIG.project = args.project[0]
     runpy.run_path(args.script)
     badass.run.report()
     if args.summary :
-        summary(args.project)
+        summary(args.project[0])
@@ -1,33 +1,43 @@
-import re, itertools
+import re, itertools, collections, weakref
 
 from functools import reduce
+from bisect import bisect_right
 from operator import xor, or_, and_
 
 from jsonpath_ng.ext import parse as jp_parse
+from jsonpath_ng.jsonpath import Child, Descendants, Root, Fields, Index, Slice
+from jsonpath_ng.ext.filter import Filter, Expression
 
 ##
 ##
 ##
 
 def _h (obj) :
-    if isinstance(obj, (str, int, float)) :
+    if isinstance(obj, (hdict, hlist)) :
+        return hash(obj)
+    elif isinstance(obj, (str, int, float)) :
         return hash(obj)
     elif isinstance(obj, (list, tuple, set)) :
-        hcn = _h(obj.__class__.__name__)
-        return hash(tuple(map(_h, obj))) ^ hcn
+        return _hseq(obj, obj.__class__)
     elif isinstance(obj, dict) :
-        hcn = _h(obj.__class__.__name__)
-        return reduce(xor, (hash((k, _h(v))) for k, v in obj.items()), hcn)
+        return _hmap(obj)
     else :
         return hash(obj)
 
+def _hseq (obj, cls) :
+    return hash(tuple(map(_h, obj))) ^ _h(cls.__name__)
+
+def _hmap (obj) :
+    # all dicts hash the same way since they compare equal whatever their class
+    return reduce(xor, (hash((k, _h(v))) for k, v in obj.items()), _h("dict"))
+
 class hdict (dict) :
     def __init__ (self, *l, **k) :
         super().__init__(*l, **k)
         self.h = None
     def __hash__ (self) :
         if self.h is None :
-            self.h = _h(self)
+            self.h = _hmap(self)
         return self.h
 
 class hlist (list) :
@@ -36,17 +46,89 @@ class hlist (list) :
         self.h = None
     def __hash__ (self) :
         if self.h is None :
-            self.h = _h(self)
+            self.h = _hseq(self, list)
         return self.h
 
 def h (obj) :
-    if isinstance(obj, dict) :
+    if isinstance(obj, (hdict, hlist)) :
+        return obj
+    elif isinstance(obj, dict) :
         return hdict(obj)
     elif isinstance(obj, list) :
         return hlist(obj)
     else :
         return obj
 
+def hcons (obj, table) :
+    """hash-cons `obj` using `table`
+
+    Its hash is computed once and for all, and if an equal object is already
+    in `table` it is returned instead. `obj` items are expected to have been
+    hash-consed already (so that they are hashed in constant time), and no
+    hash-consed object should be modified afterwards.
+    """
+    obj = h(obj)
+    return table.setdefault(obj, obj)
+
+class _Flat (object) :
+    "pre-order flattening of the lists and dicts in an AST, with subtree spans"
+    def __init__ (self, root) :
+        self.nodes = []
+        self.ends = []
+        self._pos = None
+        self._calls = {}
+        todo = [root]
+        while todo :
+            node = todo.pop()
+            if isinstance(node, int) :
+                # end marker of node number `node`
+                self.ends[node] = len(self.nodes)
+                continue
+            todo.append(len(self.nodes))
+            self.nodes.append(node)
+            self.ends.append(None)
+            if isinstance(node, dict) :
+                children = node.values()
+            else :
+                children = node
+            todo.extend(c for c in reversed(children) if isinstance(c, (dict, list)))
+    @classmethod
+    def get (cls, obj) :
+        """flattening of `obj`, kept on `obj` itself if it is hash-consed, so
+        that it lives as long as `obj` and is found only for `obj` (not for
+        an equal node)"""
+        if not isinstance(obj, (hdict, hlist)) :
+            return cls(obj)
+        flat = getattr(obj, "_flat", None)
+        if flat is None :
+            flat = obj._flat = cls(obj)
+        return flat
+    def pos (self, node) :
+        "position of `node` in the flattening, or `None`"
+        if self._pos is None :
+            self._pos = {}
+            for i, n in enumerate(self.nodes) :
+                self._pos.setdefault(id(n), i)
+        return self._pos.get(id(node), None)
+    def calls (self, kind) :
+        "positions of the calls of kind `kind`, indexed by callee name"
+        if kind not in self._calls :
+            index = self._calls[kind] = collections.defaultdict(list)
+            for i, node in enumerate(self.nodes) :
+                if isinstance(node, dict) and node.get("kind", None) == kind :
+                    name = node.get("name", None)
+                    if isinstance(name, dict) and name.get("kind", None) == "identifier" :
+                        try :
+                            index[name.get("val", None)].append(i)
+                        except TypeError :
+                            pass
+        return self._calls[kind]
+    def calls_within (self, kind, name, pos) :
+        "whether the subtree at `pos` contains a call to `name`"
+        calls = self.calls(kind).get(name, [])
+        i = bisect_right(calls, pos)
+        return i < len(calls) and calls[i] < self.ends[pos]
+
 class _TQL_OP (object) :
     def __init__ (self, op, patterns) :
         self.op = op
@@ -107,40 +189,50 @@ class TQL (object) :
         match = self * pat
         match.update(m for m in self if TQL([m]) // pat)
         return match
+    def _child (self, m, pat) :
+        if isinstance(m, dict) :
+            if isinstance(pat, str) :
+                if pat in m :
+                    yield m[pat]
+            elif isinstance(pat, dict) :
+                yield from (v for v in m.values() if self._match(v, pat))
+            else :
+                raise TypeError(f"invalid child selector {pat!r}")
+        elif isinstance(m, list) :
+            if isinstance(pat, dict) :
+                yield from (v for v in m if self._match(v, pat))
+            elif isinstance(pat, list) :
+                if self._match(m, pat) :
+                    yield m
+            elif isinstance(pat, int) :
+                if 0 <= pat < len(m) :
+                    yield m
+            else :
+                raise TypeError(f"invalid child selector {pat!r}")
+        else :
+            pass # cannot descend into other nodes
     def __truediv__ (self, pat) :
         if isinstance(pat, _TQL_OP) :
             return reduce(pat.op, (self / p for p in pat))
         match = TQL()
         for m in self :
-            if isinstance(m, dict) :
-                if isinstance(pat, str) :
-                    if pat in m :
-                        match.add(m[pat])
-                elif isinstance(pat, dict) :
-                    match.update(v for v in m.values() if self._match(v, pat))
-                else :
-                    raise TypeError(f"invalid child selector {pat!r}")
-            elif isinstance(m, list) :
-                if isinstance(pat, dict) :
-                    match.update(v for v in m if self._match(v, pat))
-                elif isinstance(pat, list) :
-                    if self._match(m, pat) :
-                        match.add(m)
-                elif isinstance(pat, int) :
-                    if 0 <= pat < len(m) :
-                        match.add(m)
-                else :
-                    raise TypeError(f"invalid child selector {pat!r}")
-            else :
-                pass # cannot descend into other nodes
+            match.update(self._child(m, pat))
         return match
     def __floordiv__ (self, other) :
-        match = self / other
+        if isinstance(other, _TQL_OP) :
+            # operators combine the matches level by level
+            match = self / other
+            for m in self :
+                if isinstance(m, list) :
+                    match.update(TQL(m) // other)
+                elif isinstance(m, dict) :
+                    match.update(TQL(m.values()) // other)
+            return match
+        match = TQL()
         for m in self :
-            if isinstance(m, list) :
-                match.update(TQL(m) // other)
-            elif isinstance(m, dict) :
-                match.update(TQL(m.values()) // other)
+            if isinstance(m, (dict, list)) :
+                for node in _Flat.get(m).nodes :
+                    match.update(self._child(node, other))
         return match
     @classmethod
     def AND (cls, *patterns) :
@@ -191,12 +283,16 @@ class TQL (object) :
         match = self // pat
         if recursive is None :
             return match
-        elif recursive :
-            return TQL([m for m in match
-                        if TQL([m]) // self.CALL(m["name"]["val"])])
-        else :
-            return TQL([m for m in match
-                        if not (TQL([m]) // self.CALL(m["name"]["val"]))])
+        flats = [_Flat.get(m) for m in self if isinstance(m, (dict, list))]
+        return TQL([m for m in match
+                    if self._recursive(m, flats) == bool(recursive)])
+    def _recursive (self, method, flats) :
+        name = method["name"]["val"]
+        for flat in flats :
+            pos = flat.pos(method)
+            if pos is not None :
+                return flat.calls_within(self._ast_call, name, pos)
+        return bool(TQL([method]) // self.CALL(name))
 
 ##
 ##
@@ -218,8 +314,132 @@ def expand (expr, lang) :
         repl = dict(zip(macros, choice))
         yield expr.format(**repl)
 
+##
+## indexed queries
+##
+
+class ASTIndex (object) :
+    """index of the nodes of an AST by `kind` and `name`
+
+    The nodes are indexed in the order jsonpath `$..*[?...]` would find them,
+    that is, the elements of every list and the values of every dict that are
+    themselves held in a dict, excluding the root. ASTs are expected not to be
+    modified once indexed.
+    """
+    KEYS = ("kind", "name")
+    def __init__ (self, ast=None) :
+        self.index = {k : collections.defaultdict(list) for k in self.KEYS}
+        if ast is not None :
+            self._walk(ast)
+    def _add (self, node) :
+        if isinstance(node, dict) :
+            for key, index in self.index.items() :
+                val = node.get(key, None)
+                if isinstance(val, str) :
+                    index[val].append(node)
+    def _walk (self, ast) :
+        # containers held in a dict are searched for matching children, the
+        # order is that of jsonpath_ng.Descendants
+        stack = [iter((ast,))]
+        while stack :
+            for obj in stack[-1] :
+                if isinstance(obj, dict) :
+                    for val in obj.values() :
+                        if isinstance(val, dict) :
+                            for child in val.values() :
+                                self._add(child)
+                        elif isinstance(val, list) :
+                            for child in val :
+                                self._add(child)
+                    stack.append(iter(obj.values()))
+                elif isinstance(obj, list) :
+                    stack.append(iter(obj))
+                break
+            else :
+                stack.pop()
+    def extend (self, other) :
+        for key, index in self.index.items() :
+            for val, nodes in other.index[key].items() :
+                index[val].extend(nodes)
+    def __call__ (self, key, val) :
+        return self.index[key].get(val, [])
+
+_index_cache = {}
+
+def index (ast) :
+    """get the `ASTIndex` of `ast`
+
+    Indexes are cached as long as `ast` is alive. A plain dict (like the
+    `{path: ast}` built by `Test.query`) is not cached but its index is composed
+    from the cached indexes of its values.
+    """
+    key = id(ast)
+    if key in _index_cache :
+        return _index_cache[key]
+    try :
+        weakref.finalize(ast, _index_cache.pop, key, None)
+    except TypeError :
+        if not isinstance(ast, dict) :
+            return ASTIndex(ast)
+        idx = ASTIndex()
+        for val in ast.values() :
+            if isinstance(val, dict) :
+                for child in val.values() :
+                    idx._add(child)
+            elif isinstance(val, list) :
+                for child in val :
+                    idx._add(child)
+        for val in ast.values() :
+            idx.extend(index(val))
+        return idx
+    idx = _index_cache[key] = ASTIndex(ast)
+    return idx
+
+_fast_cache = {}
+
+def _fast (patt) :
+    # recognise `$..*[?key='val' & ...]` possibly followed by simple selectors,
+    # return (key, val, filter, rest) so that the candidates are looked up by
+    # key=val and then checked with filter before rest is applied
+    rest = []
+    while (isinstance(patt, Child)
+           and isinstance(patt.right, (Fields, Index, Slice, Filter))) :
+        if (isinstance(patt.left, Descendants)
+            and isinstance(patt.left.left, Root)
+            and patt.left.right == Fields("*")
+            and isinstance(patt.right, Filter)) :
+            break
+        rest.append(patt.right)
+        patt = patt.left
+    else :
+        return None
+    eqs = {}
+    for expr in patt.right.expressions :
+        if (isinstance(expr, Expression)
+            and expr.op in ("=", "==")
+            and isinstance(expr.value, str)
+            and isinstance(expr.target, Fields)
+            and len(expr.target.fields) == 1) :
+            eqs.setdefault(expr.target.fields[0], expr.value)
+    for key in ASTIndex.KEYS :
+        if key in eqs :
+            return key, eqs[key], patt.right.expressions, rest[::-1]
+
 def query (pattern, ast) :
     patt = parse(pattern)
-    for match in patt.find(ast) :
-        yield match.value
+    if pattern not in _fast_cache :
+        _fast_cache[pattern] = _fast(patt)
+    fast = _fast_cache[pattern]
+    if fast is None :
+        for match in patt.find(ast) :
+            yield match.value
+        return
+    key, val, exprs, rest = fast
+    for node in index(ast)(key, val) :
+        if not all(expr.find(node) for expr in exprs) :
+            continue
+        found = [node]
+        for sel in rest :
+            found = [m.value for f in found for m in sel.find(f)]
+        yield from found
 
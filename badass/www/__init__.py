@@ -1,3 +1,5 @@
+import sys, csv
+
 from pathlib import Path
 from shutil import copyfile
 from secrets import token_bytes
@@ -129,3 +131,33 @@ def add_user (args) :
     if not USER.add(**fields) :
         print("failed, this email may be already in use")
         sys.exit(1)
+
+def add_users (args) :
+    from ..db import connect
+    from ..mkpass import strong
+    DB, CFG, USER, ROLES = connect(args.dbpath)
+    failed = 0
+    # users are committed all at once, invalid lines are skipped
+    with USER.batch() :
+        for num, row in enumerate(csv.DictReader(args.users), 2) :
+            fields = {key : (row.get(key, None) or "").strip()
+                      for key in ("email", "firstname", "lastname", "studentid",
+                                  "group", "roles", "password", "activated")}
+            fields["roles"] = fields["roles"].split()
+            fields["activated"] = fields["activated"].lower()[:1] in ("y", "t", "1")
+            if not fields["email"] :
+                error = "missing email"
+            elif fields["group"] and fields["group"].upper() not in CFG.GROUPS :
+                error = f"invalid group {fields['group']!r}"
+            elif not all(r in ROLES for r in fields["roles"]) :
+                error = f"invalid roles {' '.join(fields['roles'])!r}"
+            elif not strong(fields["password"]) :
+                error = "password is not strong enough"
+            elif not USER.add(**fields) :
+                error = f"{fields['email']} may be already in use"
+            else :
+                continue
+            print(f"line {num}: failed, {error}")
+            failed += 1
+    if failed :
+        sys.exit(1)
@@ -56,6 +56,12 @@ def add_arguments (sub) :
                            help="new user's role (reuse option to add several)")
     role_excl.add_argument("--no-roles", dest="roles", action="store_const", const=[],
                            help="set new user with no roles")
+    group.add_argument("--from-csv", dest="users", metavar="CSV",
+                       type=argparse.FileType(mode="r", encoding="utf-8"),
+                       default=None,
+                       help=("add all the users from CSV (with columns email,"
+                             " firstname, lastname, studentid, group, roles,"
+                             " password and activated) instead of just one"))
     #
     excl.add_argument("-s", "--serve", default=False, action="store_true",
                        help="start Flask server")
@@ -66,6 +72,29 @@ def add_arguments (sub) :
                        help="Flask environ (default: development)")
     group.add_argument("--reload", default=False, action="store_true",
                        help="enable Flask auto reload")
+    group = sub.add_argument_group("production server options (requires gunicorn)")
+    group.add_argument("--workers", metavar="NUM", type=int, default=None,
+                       help="serve with NUM preforked processes instead of"
+                       " Flask development server")
+    group.add_argument("--threads", metavar="NUM", type=int, default=4,
+                       help="number of threads in each worker process (default: 4)")
+    group.add_argument("--bind", metavar="ADDRESS", default="127.0.0.1:5000",
+                       help="listen on ADDRESS (default: 127.0.0.1:5000)")
+    group.add_argument("--timeout", metavar="SECONDS", type=int, default=300,
+                       help="restart workers silent for more than SECONDS, and"
+                       " give them as much time to finish their requests on"
+                       " restarts (default: 300, to allow for long uploads)")
+    #
+    excl.add_argument("-g", "--grader", default=False, action="store_true",
+                      help="start grading daemon")
+    group = sub.add_argument_group("grading daemon options")
+    group.add_argument("--socket", metavar="PATH", default="data/grader.sock",
+                       help="listen on Unix socket PATH (default: data/grader.sock)")
+    group.add_argument("--jobs", metavar="NUM", type=int, default=None,
+                       help="run at most NUM jobs at once (default: number of CPUs)")
+    group.add_argument("--cap", metavar="NUM", type=int, default=2,
+                       help="run at most NUM jobs at once for the same user"
+                       " (default: 2)")
 
 def main (args) :
     "www server and utilities"
@@ -78,8 +107,31 @@ def main (args) :
         from . import copy_static
         copy_static(pathlib.Path(args.init), args.clobber)
     elif args.dbpath is not None :
-        from . import add_user
-        add_user(args)
+        if args.users is not None :
+            from . import add_users
+            add_users(args)
+        else :
+            from . import add_user
+            add_user(args)
+    elif args.serve and args.workers :
+        try :
+            import gunicorn
+        except ImportError :
+            print("error: install gunicorn to use --workers", file=sys.stderr)
+            sys.exit(1)
+        # app is preloaded before workers are forked, and HUP to the master
+        # process restarts them gracefully
+        argv = [sys.executable, "-m", "gunicorn",
+                "--preload",
+                "--workers", str(args.workers),
+                "--threads", str(args.threads),
+                "--bind", args.bind,
+                "--timeout", str(args.timeout),
+                "--graceful-timeout", str(args.timeout),
+                "--keep-alive", "5",
+                "--access-logfile", "-",
+                "badass.www.server:app"]
+        subprocess.run(argv)
     elif args.serve :
         env = dict(os.environ)
         env["FLASK_APP"] = "badass.www.server"
@@ -90,5 +142,8 @@ def main (args) :
         if not args.reload :
             argv.append("--no-reload")
         subprocess.run(argv, env=env)
+    elif args.grader :
+        from .grader import Daemon
+        Daemon(args.socket, jobs=args.jobs, cap=args.cap).serve()
     else :
         raise RuntimeError("unreachable code has been reached (LOL)")
@@ -0,0 +1,222 @@
+"""resident grading daemon
+
+The daemon imports badass and its languages once, then forks a fixed number
+of workers. Each worker takes jobs from a persistent `JobQueue` and runs
+every job in a child forked from itself, so jobs start with warm imports but
+cannot interfere with each other. A job is a `badass` command line.
+
+Clients talk to the daemon through a Unix socket, sending one JSON request per
+line and receiving one JSON answer per line.
+"""
+
+import os, sys, json, time, signal, socket, socketserver, tempfile, traceback
+
+from pathlib import Path
+
+from .jobs import JobQueue
+
+##
+## daemon
+##
+
+def _warmup () :
+    import badass.__main__, badass.run, badass.report, badass.lang
+    list(badass.lang.supported())
+
+def _run (queue, job) :
+    import badass.__main__
+    payload = job["payload"]
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err :
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        try :
+            badass.__main__.main([str(a) for a in payload["argv"]])
+            code = 0
+        except SystemExit as exc :
+            code = exc.code if isinstance(exc.code, int) else int(exc.code is not None)
+        except :
+            traceback.print_exc()
+            code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        out.seek(0)
+        err.seek(0)
+        stdout, stderr = out.read(), err.read()
+    if payload.get("log", None) :
+        with open(payload["log"], "wb") as log :
+            log.write(b"<h5>STDOUT</h5>\n<pre>\n")
+            log.write(stdout)
+            log.write(b"</pre>\n<h5>STDERR</h5>\n<pre>\n")
+            log.write(stderr)
+            log.write(b"</pre>\n")
+    result = {"code" : code}
+    if code :
+        result["error"] = stderr.decode("utf-8", errors="replace")
+    queue.finish(job["id"], result, failed=bool(code))
+
+def _worker (queue, delay) :
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    child = None
+    def terminate (signum, frame) :
+        # the job of a killed child is left running, and queued again by
+        # `JobQueue.reclaim` since its owner is dead
+        if child is not None :
+            try :
+                os.killpg(child, signal.SIGTERM)
+                os.waitpid(child, 0)
+            except (ProcessLookupError, ChildProcessError) :
+                pass
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    while True :
+        job = queue.take()
+        if job is None :
+            time.sleep(delay)
+            continue
+        # SIGTERM is held until child is known, so that it is not left behind
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        pid = os.fork()
+        if pid == 0 :
+            try :
+                # child and the processes it starts are killed together
+                os.setpgid(0, 0)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+                queue.own(job["id"], os.getpid())
+                _run(queue, job)
+            finally :
+                os._exit(0)
+        try :
+            os.setpgid(pid, pid)
+        except OSError :
+            # child has already done it
+            pass
+        child = pid
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+        _, status = os.waitpid(pid, 0)
+        child = None
+        if queue.get(job["id"])["state"] == "running" :
+            queue.finish(job["id"],
+                         {"code" : status,
+                          "error" : f"job process exited with status {status}"},
+                         failed=True)
+
+def _stop (signum, frame) :
+    sys.exit(0)
+
+class _Handler (socketserver.StreamRequestHandler) :
+    def handle (self) :
+        for line in self.rfile :
+            try :
+                answer = self.server.answer(json.loads(line))
+            except Exception as err :
+                answer = {"error" : f"{err.__class__.__name__}: {err}"}
+            self.wfile.write(json.dumps(answer).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+class _Server (socketserver.ThreadingUnixStreamServer) :
+    daemon_threads = True
+    def __init__ (self, path, queue) :
+        self.queue = queue
+        super().__init__(path, _Handler)
+    def answer (self, request) :
+        op = request.get("op", None)
+        if op == "submit" :
+            return {"id" : self.queue.submit(request["kind"],
+                                             request.get("payload", None),
+                                             request.get("user", None),
+                                             request.get("priority", "batch"))}
+        elif op == "status" :
+            job = self.queue.get(request["id"])
+            if job is None :
+                return {"error" : f"no such job {request['id']!r}"}
+            if job["state"] == "queued" :
+                job["position"] = self.queue.position(job["id"])
+            return job
+        elif op == "queue" :
+            return {"jobs" : self.queue.summary()}
+        elif op == "ping" :
+            return {"pong" : os.getpid()}
+        else :
+            raise ValueError(f"unknown operation {op!r}")
+
+class Daemon (object) :
+    def __init__ (self, path="data/grader.sock", queue="data/grader.sqlite",
+                  jobs=None, delay=0.2, cap=None) :
+        self.path = Path(path)
+        self.queue = JobQueue(queue, cap=cap)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.delay = delay
+    def serve (self) :
+        _warmup()
+        # only the jobs whose process is dead, another daemon may be running
+        recovered = self.queue.reclaim()
+        if recovered :
+            print(f"recovered {recovered} interrupted job(s)")
+        # workers are forked before the server starts its threads
+        workers = []
+        for num in range(self.jobs) :
+            pid = os.fork()
+            if pid == 0 :
+                try :
+                    _worker(self.queue, self.delay)
+                finally :
+                    os._exit(1)
+            workers.append(pid)
+        if self.path.exists() :
+            self.path.unlink()
+        server = _Server(str(self.path), self.queue)
+        print(f"grading daemon listening on {self.path} with {self.jobs} worker(s)")
+        # service managers stop the daemon with SIGTERM
+        signal.signal(signal.SIGTERM, _stop)
+        try :
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit) :
+            pass
+        finally :
+            server.server_close()
+            self.path.unlink(missing_ok=True)
+            # workers kill their running jobs before they exit
+            for pid in workers :
+                try :
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except (ProcessLookupError, ChildProcessError) :
+                    pass
+
+##
+## client
+##
+
+class Client (object) :
+    def __init__ (self, path="data/grader.sock") :
+        self.path = str(path)
+    def _call (self, **request) :
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock :
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as stream :
+                answer = json.loads(stream.readline())
+        if "error" in answer and request["op"] != "status" :
+            raise RuntimeError(answer["error"])
+        return answer
+    def submit (self, argv, log=None, user=None, kind=None, priority="batch") :
+        "queue badass command line `argv` and return the job id"
+        argv = [str(a) for a in argv]
+        return self._call(op="submit", kind=kind or argv[0], user=user,
+                          priority=priority,
+                          payload={"argv" : argv, "log" : log and str(log)})["id"]
+    def status (self, job_id) :
+        return self._call(op="status", id=job_id)
+    def queue (self) :
+        "summary of queued and running jobs (see `JobQueue.summary`)"
+        return self._call(op="queue")["jobs"]
+    def wait (self, job_id, delay=0.5) :
+        "wait for job `job_id` to be over and return it"
+        while True :
+            job = self.status(job_id)
+            if job.get("state", None) not in ("queued", "running") :
+                return job
+            time.sleep(delay)
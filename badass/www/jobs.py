@@ -0,0 +1,229 @@
+import sqlite3, json, os, threading, time, collections
+
+# priority classes, lower values are run first
+PRIORITY = {"interactive" : 0,
+            "report" : 1,
+            "batch" : 2}
+
+def _alive (pid) :
+    try :
+        os.kill(pid, 0)
+    except ProcessLookupError :
+        return False
+    except PermissionError :
+        pass
+    return True
+
+class JobQueue (object) :
+    """persistent queue of jobs stored in a SQLite database
+
+    A job has a `kind`, the `user` it runs for, a `priority` class, and a JSON
+    `payload`. It is `queued` first, then `running`, and eventually `done` or
+    `failed` with a JSON `result`. The queue may be shared between threads and
+    processes.
+
+    Jobs are taken by priority first, then from the users that have the less
+    jobs running, then in order of submission. If `cap` is not `None`, a user
+    cannot have more than `cap` jobs running at once.
+
+    A running job records the pid of the process that runs it, which is the
+    process that took it unless `own` is called. When this process dies (for
+    instance a recycled server worker), its jobs are queued again by `reclaim`,
+    which `take` calls at most every `reclaim_every` seconds (never if it is
+    `None`).
+    """
+    def __init__ (self, path, table="jobs", cap=None, reclaim_every=60) :
+        self.path = str(path)
+        self.table = table
+        self.cap = cap
+        self.reclaim_every = reclaim_every
+        self._reclaimed = 0.0
+        self._local = threading.local()
+        db = self._db
+        db.execute(f"CREATE TABLE IF NOT EXISTS {table} ("
+                   " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                   " kind TEXT NOT NULL,"
+                   " user TEXT,"
+                   " priority INTEGER NOT NULL DEFAULT 0,"
+                   " state TEXT NOT NULL DEFAULT 'queued',"
+                   " owner INTEGER,"
+                   " payload TEXT,"
+                   " result TEXT,"
+                   " created REAL,"
+                   " started REAL,"
+                   " finished REAL)")
+        columns = {row["name"] for row in db.execute(f"PRAGMA table_info({table})")}
+        if "priority" not in columns :
+            db.execute(f"ALTER TABLE {table}"
+                       " ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if "owner" not in columns :
+            db.execute(f"ALTER TABLE {table} ADD COLUMN owner INTEGER")
+        db.execute(f"CREATE INDEX IF NOT EXISTS {table}_state"
+                   f" ON {table} (state, id)")
+        db.execute(f"CREATE INDEX IF NOT EXISTS {table}_schedule"
+                   f" ON {table} (state, priority, id)")
+    @property
+    def _db (self) :
+        # one connection per thread, and a new one after fork
+        pid, db = getattr(self._local, "db", (None, None))
+        if pid != os.getpid() :
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = (os.getpid(), db)
+        return db
+    def _job (self, row) :
+        if row is None :
+            return None
+        job = dict(row)
+        for key in ("payload", "result") :
+            if job[key] is not None :
+                job[key] = json.loads(job[key])
+        return job
+    def submit (self, kind, payload, user=None, priority="batch") :
+        "add a new job and return its id"
+        cur = self._db.execute(f"INSERT INTO {self.table}"
+                               " (kind, user, priority, payload, created)"
+                               " VALUES (?, ?, ?, ?, ?)",
+                               (kind, user, PRIORITY[priority],
+                                json.dumps(payload), time.time()))
+        return cur.lastrowid
+    def reclaim (self) :
+        """queue again the running jobs whose owner process is not alive anymore,
+        and return their number"""
+        db = self._db
+        count = 0
+        for (pid,) in db.execute(f"SELECT DISTINCT owner FROM {self.table}"
+                                 " WHERE state = 'running'").fetchall() :
+            # jobs without owner were taken before owners were recorded
+            if pid is None or not _alive(pid) :
+                count += db.execute(f"UPDATE {self.table}"
+                                    " SET state = 'queued', started = NULL,"
+                                    " owner = NULL"
+                                    " WHERE state = 'running' AND owner IS ?",
+                                    (pid,)).rowcount
+        return count
+    def own (self, job_id, pid) :
+        "record that running job `job_id` is now run by process `pid`"
+        self._db.execute(f"UPDATE {self.table} SET owner = ?"
+                         " WHERE id = ? AND state = 'running'",
+                         (pid, job_id))
+    def take (self) :
+        "mark the next job to run as running and return it, or `None`"
+        db = self._db
+        now = time.time()
+        if (self.reclaim_every is not None
+            and now - self._reclaimed >= self.reclaim_every) :
+            self._reclaimed = now
+            self.reclaim()
+        # lock the queue only if there is something to do
+        if db.execute(f"SELECT 1 FROM {self.table}"
+                      " WHERE state = 'queued' LIMIT 1").fetchone() is None :
+            return None
+        db.execute("BEGIN IMMEDIATE")
+        try :
+            row = db.execute(f"SELECT queued.* FROM {self.table} AS queued"
+                             " LEFT JOIN (SELECT user, COUNT(*) AS running"
+                             f"            FROM {self.table}"
+                             "            WHERE state = 'running'"
+                             "            GROUP BY user) AS busy"
+                             " ON queued.user = busy.user"
+                             " WHERE queued.state = 'queued'"
+                             " AND (? IS NULL OR queued.user IS NULL"
+                             "      OR COALESCE(busy.running, 0) < ?)"
+                             " ORDER BY queued.priority,"
+                             " COALESCE(busy.running, 0),"
+                             " queued.id LIMIT 1",
+                             (self.cap, self.cap)).fetchone()
+            if row is not None :
+                db.execute(f"UPDATE {self.table}"
+                           " SET state = 'running', started = ?, owner = ?"
+                           " WHERE id = ?",
+                           (time.time(), os.getpid(), row["id"]))
+        except :
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        job = self._job(row)
+        if job is not None :
+            job["state"] = "running"
+            job["owner"] = os.getpid()
+        return job
+    def finish (self, job_id, result=None, failed=False) :
+        "record that job `job_id` is over"
+        self._db.execute(f"UPDATE {self.table}"
+                         " SET state = ?, result = ?, finished = ?"
+                         " WHERE id = ?",
+                         ("failed" if failed else "done", json.dumps(result),
+                          time.time(), job_id))
+    def get (self, job_id) :
+        "job `job_id` as a dict, or `None` if there is no such job"
+        return self._job(self._db.execute(f"SELECT * FROM {self.table}"
+                                          " WHERE id = ?",
+                                          (job_id,)).fetchone())
+    def position (self, job_id) :
+        """number of queued jobs that should be run before job `job_id`
+
+        Jobs are taken in turn as `take` would do, assuming that no job
+        completes and none is submitted meanwhile. When every job left belongs
+        to a user at its cap, the next one is taken as if a job of this user
+        had completed.
+        """
+        db = self._db
+        queued = db.execute(f"SELECT id, user, priority FROM {self.table}"
+                            " WHERE state = 'queued' ORDER BY id").fetchall()
+        if job_id not in {row["id"] for row in queued} :
+            return 0
+        running = collections.Counter()
+        for row in db.execute(f"SELECT user, COUNT(*) AS running FROM {self.table}"
+                              " WHERE state = 'running' AND user IS NOT NULL"
+                              " GROUP BY user") :
+            running[row["user"]] = row["running"]
+        def key (row) :
+            return (row["priority"],
+                    0 if row["user"] is None else running[row["user"]],
+                    row["id"])
+        ahead = 0
+        while True :
+            ready = [row for row in queued
+                     if self.cap is None or row["user"] is None
+                     or running[row["user"]] < self.cap]
+            row = min(ready or queued, key=key)
+            if row["id"] == job_id :
+                return ahead
+            ahead += 1
+            queued.remove(row)
+            if row["user"] is not None :
+                running[row["user"]] += 1
+    def count (self, *states) :
+        "number of jobs in any of `states` (all the jobs if none is given)"
+        if not states :
+            return self._db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        marks = ", ".join("?" for s in states)
+        return self._db.execute(f"SELECT COUNT(*) FROM {self.table}"
+                                f" WHERE state IN ({marks})",
+                                states).fetchone()[0]
+    def summary (self) :
+        """queued and running jobs counted by priority class, kind, state and
+        user, as a list of dicts"""
+        names = {v : k for k, v in PRIORITY.items()}
+        rows = self._db.execute("SELECT priority, kind, state, user, COUNT(*) AS jobs,"
+                                " MIN(created) AS oldest"
+                                f" FROM {self.table}"
+                                " WHERE state IN ('queued', 'running')"
+                                " GROUP BY priority, kind, state, user"
+                                " ORDER BY priority, kind, state, user")
+        return [dict(row, priority=names.get(row["priority"], row["priority"]))
+                for row in rows]
+    def recover (self) :
+        "queue again the jobs that were running when the queue was last stopped"
+        return self._db.execute(f"UPDATE {self.table}"
+                                " SET state = 'queued', started = NULL,"
+                                " owner = NULL"
+                                " WHERE state = 'running'").rowcount
+    def purge (self, age) :
+        "delete the jobs completed more than `age` seconds ago"
+        return self._db.execute(f"DELETE FROM {self.table}"
+                                " WHERE state IN ('done', 'failed')"
+                                " AND finished < ?",
+                                (time.time() - age,)).rowcount
@@ -1,8 +1,8 @@
-import collections, time, pathlib, threading, zipfile, json, subprocess, secrets, os, sys, mimetypes, random, itertools, traceback, re, ast, tempfile, io, csv
+import collections, time, pathlib, threading, zipfile, json, subprocess, secrets, os, sys, mimetypes, random, itertools, traceback, re, ast, io, csv, gzip, hashlib, shutil
 
 from operator import or_
 from datetime import datetime
-from functools import wraps, reduce
+from functools import wraps, reduce, partial
 from pprint import pformat
 
 from flask import (
@@ -20,17 +20,26 @@ from flask import (
     send_file,
     jsonify,
     g,
+    stream_with_context,
 )
 from werkzeug.utils import secure_filename
-from werkzeug.exceptions import HTTPException, InternalServerError
+from werkzeug.exceptions import HTTPException, InternalServerError, ServiceUnavailable
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from pygments import highlight
 from pygments.lexers import PythonLexer, PythonTracebackLexer
 from pygments.formatters import HtmlFormatter
 
-from ..db import connect
+try:
+    import brotli
+except:
+    brotli = None
+
+from ..db import connect, catalogue_add
+from ..db.blobs import BlobStore, manifest
 from ..mkpass import pwgen
+from .grader import Client
+from .jobs import JobQueue
 
 import badass
 
@@ -50,6 +59,8 @@ UPLOAD = pathlib.Path("upload")
 UPLOAD.mkdir(exist_ok=True, parents=True)
 REPORT = pathlib.Path("reports")
 REPORT.mkdir(exist_ok=True, parents=True)
+# uploaded files are stored once, submissions linking to them
+BLOBS = BlobStore(UPLOAD / ".blobs")
 ERROR = pathlib.Path("errors")
 ERROR.mkdir(exist_ok=True, parents=True)
 
@@ -68,6 +79,8 @@ ANIMS = [
 
 DB, CFG, USER, ROLES = connect("data")
 
+GRADER = Client("data/grader.sock")
+
 ##
 ## flask app starts here
 ##
@@ -161,85 +174,232 @@ def logout():
 ## asynchronous API for long running tasks
 ##
 
-tasks = {}
+# tasks are stored in a SQLite queue, so that they survive a restart, and run
+# by a fixed pool of threads, new tasks being rejected when too many are pending;
+# they are scheduled by priority (see async_api) and fairly among users, each
+# user having at most TASKS_CAP tasks running
+
+TASKS_CAP = CFG.TASKS.get("cap", 2)
+TASKS_RECLAIM = CFG.TASKS.get("reclaim", 60)
+TASKS = JobQueue(
+    "data/tasks.sqlite", "tasks", cap=TASKS_CAP, reclaim_every=TASKS_RECLAIM
+)
+TASKS_WORKERS = CFG.TASKS.get("workers", 4)
+TASKS_BACKLOG = CFG.TASKS.get("backlog", 64)
+TASKS_KEEP = CFG.TASKS.get("keep", 300)
+TASKS_POLL = CFG.TASKS.get("poll", 1)
+
+# the tasks left running by server processes that are gone are queued again at
+# import, and then every TASKS_RECLAIM seconds by the task threads; tasks whose
+# process is alive are left alone
+_recovered = TASKS.reclaim()
+if _recovered:
+    print(f" # Recovered {_recovered} interrupted task(s)")
+
+# _tasks_ready only wakes up the threads of the process that submitted a task,
+# the tasks submitted to other server processes are found by polling the queue
+# every TASKS_POLL seconds
+
+_tasks_views = {}
+_tasks_ready = threading.Semaphore(0)
+
+
+def run_task(task):
+    payload = task["payload"]
+    view = _tasks_views.get(payload["endpoint"], None)
+    if view is None:
+        TASKS.finish(task["id"], {"error": "unknown endpoint"}, failed=True)
+        return
+    with app.test_request_context(payload["path"], base_url=payload["base_url"]):
+        session.update(app.session_interface.serializer.loads(payload["session"]))
+        load_user()
+        try:
+            ret = view(*payload["args"], **payload["kwargs"])
+        except HTTPException as e:
+            ret = current_app.handle_http_exception(e)
+        except Exception as err:
+            ret = handle_exception(err)
+        resp = app.make_response(ret)
+        TASKS.finish(
+            task["id"],
+            {
+                "status": resp.status_code,
+                "headers": [
+                    (k, v) for k, v in resp.headers.items() if k != "Content-Length"
+                ],
+                "body": resp.get_data(as_text=True),
+            },
+        )
+
+
+def task_worker():
+    purged = 0.0
+    while True:
+        task = TASKS.take()
+        if task is None:
+            if time.time() - purged >= TASKS_KEEP:
+                TASKS.purge(TASKS_KEEP)
+                purged = time.time()
+            _tasks_ready.acquire(timeout=TASKS_POLL)
+        else:
+            try:
+                run_task(task)
+            except Exception as err:
+                TASKS.finish(task["id"], {"error": str(err)}, failed=True)
+            # a task held back by the cap may be runnable now
+            _tasks_ready.release()
 
 
 @app.before_first_request
 def before_first_request():
-    def clean_old_tasks():
-        global tasks
-        while True:
-            time.sleep(60)
-            five_min_ago = datetime.timestamp(datetime.utcnow()) - 300
-            for task_id, task in list(tasks.items()):
-                if task.get("completion_timestamp", five_min_ago) < five_min_ago:
-                    print(f" # Dropping task {task_id}")
-                    del tasks[task_id]
+    for num in range(TASKS_WORKERS):
+        thread = threading.Thread(target=task_worker, daemon=True)
+        thread.start()
+    for num in range(TASKS.count("queued")):
+        _tasks_ready.release()
 
-    thread = threading.Thread(target=clean_old_tasks)
-    thread.start()
 
+def async_api(wrapped_function=None, priority="interactive"):
+    if wrapped_function is None:
+        return partial(async_api, priority=priority)
+    _tasks_views[wrapped_function.__name__] = wrapped_function
 
-def async_api(wrapped_function):
     @wraps(wrapped_function)
     def new_function(*args, **kwargs):
-        global tasks
-
-        def task_call(flask_app, environ):
-            global tasks
-            with flask_app.request_context(environ):
-                try:
-                    tasks[task_id]["return_value"] = wrapped_function(*args, **kwargs)
-                except HTTPException as e:
-                    tasks[task_id]["return_value"] = current_app.handle_http_exception(
-                        e
-                    )
-                except Exception as err:
-                    tasks[task_id]["return_value"] = handle_exception(err)
-                finally:
-                    now = datetime.timestamp(datetime.utcnow())
-                    tasks[task_id]["completion_timestamp"] = now
-
-        task_id = secrets.token_urlsafe()
-        tasks[task_id] = {
-            "task_thread": threading.Thread(
-                target=task_call,
-                args=(current_app._get_current_object(), request.environ),
+        if TASKS.count("queued", "running") >= TASKS_BACKLOG:
+            raise ServiceUnavailable(
+                "Too many requests are being processed, please retry in a while.",
+                retry_after=30,
             )
-        }
-        tasks[task_id]["task_thread"].start()
+        task_id = TASKS.submit(
+            wrapped_function.__name__,
+            {
+                "endpoint": wrapped_function.__name__,
+                "path": request.full_path,
+                "base_url": request.url_root,
+                "session": app.session_interface.serializer.dumps(dict(session)),
+                "args": args,
+                "kwargs": kwargs,
+            },
+            user=str(g.user.id),
+            priority=priority,
+        )
+        _tasks_ready.release()
         return render_template(
             "wait.html",
             status_url=url_for("gettaskstatus", task_id=task_id),
+            events_url=url_for("gettaskevents", task_id=task_id),
             anim=random.choice(ANIMS),
         )
 
     return new_function
 
 
-@app.route("/status/<task_id>")
-def gettaskstatus(task_id):
+def get_task(task_id):
     check_auth(ERROR=401)
-    global tasks
-    task = tasks.get(task_id, None)
-    if task is None:
+    task = TASKS.get(task_id)
+    if task is None or task["user"] != str(g.user.id):
         abort(404)
-    if "return_value" in task:
+    return task
+
+
+@app.route("/status/<int:task_id>")
+def gettaskstatus(task_id):
+    task = get_task(task_id)
+    if task["state"] in ("done", "failed"):
         return jsonify(
             {"wait": False, "link": url_for("gettaskresult", task_id=task_id)}
         )
+    elif task["state"] == "queued":
+        return jsonify({"wait": True, "position": TASKS.position(task_id) + 1})
     else:
-        return jsonify({"wait": True})
+        return jsonify({"wait": True, "position": 0})
 
 
-@app.route("/result/<task_id>")
+# progress of a task is pushed to the browser as server-sent events: its position
+# in queue while it waits, then the tests as `badass run` completes them (read
+# from the progress file it writes into the project directory), and eventually
+# the link to its result
+
+# a stream holds a server thread as long as it runs, so only a few of them are
+# served at once by each process, and the other pages poll `/status` instead
+
+TASKS_EVENTS_DELAY = 0.5
+TASKS_EVENTS_KEEPALIVE = 15
+TASKS_EVENTS_MAX = CFG.TASKS.get("events", 2)
+_events_slots = threading.BoundedSemaphore(TASKS_EVENTS_MAX)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/events/<int:task_id>")
+def gettaskevents(task_id):
+    task = get_task(task_id)
+    link = url_for("gettaskresult", task_id=task_id)
+    progress = None
+    if task["kind"] == "result":
+        # only grading tasks write a progress file, into their project
+        try:
+            state = app.session_interface.serializer.loads(task["payload"]["session"])
+            progress = pathlib.Path(state["form"]["base"]) / "progress.jsonl"
+        except (KeyError, TypeError):
+            pass
+    if not _events_slots.acquire(blocking=False):
+        # 204 tells EventSource not to reconnect, the page falls back to polling
+        return Response(status=204)
+
+    def stream():
+        try:
+            yield from follow()
+        finally:
+            _events_slots.release()
+
+    def follow():
+        position, offset, idle = None, 0, 0.0
+        yield "retry: 2000\n\n"
+        while True:
+            task = TASKS.get(task_id)
+            if task["state"] == "queued":
+                pos = TASKS.position(task_id) + 1
+                if pos != position:
+                    position, idle = pos, 0.0
+                    yield _sse("position", {"position": pos})
+            elif progress is not None and progress.exists():
+                with progress.open("rb") as log:
+                    log.seek(offset)
+                    for line in log:
+                        if not line.endswith(b"\n"):
+                            break
+                        offset += len(line)
+                        event = json.loads(line)
+                        idle = 0.0
+                        yield _sse(event.pop("event"), event)
+            if task["state"] in ("done", "failed"):
+                yield _sse("result", {"link": link})
+                return
+            if idle >= TASKS_EVENTS_KEEPALIVE:
+                idle = 0.0
+                yield ": keepalive\n\n"
+            time.sleep(TASKS_EVENTS_DELAY)
+            idle += TASKS_EVENTS_DELAY
+
+    resp = Response(stream_with_context(stream()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+@app.route("/result/<int:task_id>")
 def gettaskresult(task_id):
-    check_auth(ERROR=401)
-    global tasks
-    task = tasks.get(task_id, None)
-    if task is None:
+    task = get_task(task_id)
+    result = task["result"] or {}
+    if task["state"] not in ("done", "failed"):
         abort(404)
-    return task.get("return_value")
+    elif "status" not in result:
+        return handle_exception(RuntimeError(result.get("error", "task failed")))
+    return Response(result["body"], status=result["status"], headers=result["headers"])
 
 
 ##
@@ -426,9 +586,11 @@ def index():
     srcpath = base / "src"
     srcpath.mkdir(parents=True, exist_ok=True)
     # save files
+    zips = []
     for src in files:
         if src.filename.lower().endswith(".zip"):
             zpath = base / secure_filename(src.filename)
+            zips.append(zpath)
             src.save(str(zpath))
             try:
                 with zipfile.ZipFile(zpath) as zf:
@@ -437,6 +599,7 @@ def index():
                 flash(f"could not unzip '{src.filename}'", error)
         else:
             src.save(str(srcpath / secure_filename(src.filename)))
+    BLOBS.archive(base, srcpath, *zips)
     # save request info
     info = {"path": str(base), "user": dict(g.user), "form": dict(request.form)}
     with (base / "request.json").open("w", encoding="utf-8", errors="replace") as out:
@@ -446,6 +609,7 @@ def index():
         form["subid"] = DB.submissions.insert(
             user=g.user.id, date=now, course=course, exercise=exo, path=str(base)
         )
+        catalogue_add(DB, course, exo, g.user.id)
     except:
         DB.rollback()
         raise
@@ -471,6 +635,58 @@ def check_output(*l, **k):
             out.write(b"</pre>\n")
 
 
+def grade(argv, log=None, priority="interactive"):
+    "run badass command `argv` with the grading daemon, or in a new process"
+    try:
+        job_id = GRADER.submit(argv, log=log, user=str(g.user.id), priority=priority)
+    except OSError:
+        # daemon is not running
+        check_output(["python3", "-m", "badass"] + argv, env=ENV, log=log)
+        return
+    job = GRADER.wait(job_id)
+    if job.get("state", None) != "done":
+        error = (job.get("result") or {}).get("error", job.get("error", ""))
+        raise RuntimeError(f"grading job {job_id} failed\n{error}")
+
+
+# a submission is graded only if no earlier submission from the same user had
+# the same digest, computed from everything the grading depends on, otherwise
+# the earlier report is reused, unless the script opts out with a line
+# `# badass: no-reuse` (for instance because it reads the `subid` define,
+# which differs for every submission and is left out of the digest)
+
+NO_REUSE = re.compile(rb"^#\s*badass:\s*no-reuse\s*$", re.M)
+
+
+def submission_digest(script, srcpath, define):
+    digest = hashlib.sha256()
+    digest.update(pathlib.Path(script).read_bytes())
+    digest.update(json.dumps(define, sort_keys=True, default=str).encode("utf-8"))
+    for path in sorted(p for p in srcpath.rglob("*") if p.is_file()):
+        data = path.read_bytes()
+        digest.update(
+            f"\0{path.relative_to(srcpath)}\0{len(data)}\0".encode("utf-8", "replace")
+        )
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def reuse_report(subid, digest, project):
+    "copy a report graded earlier for `digest` into `project`"
+    rows = DB(
+        (DB.submissions.digest == digest)
+        & (DB.submissions.user == g.user.id)
+        & (DB.submissions.id != subid)
+    ).select(DB.submissions.path, orderby=~DB.submissions.id)
+    for row in rows:
+        report = pathlib.Path(row.path) / "report.zip"
+        if report.exists():
+            # not a hard link: each submission must own its report
+            shutil.copy2(report, project / "report.zip")
+            return True
+    return False
+
+
 @app.route("/result")
 @async_api
 def result():
@@ -481,6 +697,7 @@ def result():
         return redirect(url_for("index"))
     script = pathlib.Path(form.pop("path"))
     project = pathlib.Path(form.pop("base"))
+    subid = form.get("subid", None)
     define = []
     logpath = None
     if form.get("debug", False):
@@ -490,11 +707,27 @@ def result():
         if isinstance(val, str):
             val = val.encode("ascii", "replace").decode("ascii", "replace")
         define.extend(["-d", f"{key}={val}"])
-    check_output(
-        ["python3", "-m", "badass", "run", script, project] + define,
-        env=ENV,
-        log=logpath,
+    # subid is different for every submission, so it is left out of the digest;
+    # debugging always regrades
+    digest = submission_digest(
+        script, project / "src", {k: v for k, v in form.items() if k != "subid"}
     )
+    reusable = (
+        not logpath
+        and subid is not None
+        and not NO_REUSE.search(script.read_bytes())
+    )
+    cached = reusable and reuse_report(subid, digest, project)
+    if not cached:
+        grade(["run", script, project] + define, log=logpath)
+    if subid is not None:
+        try:
+            DB(DB.submissions.id == subid).update(digest=digest, cached=cached)
+        except:
+            DB.rollback()
+            raise
+        else:
+            DB.commit()
     with zipfile.ZipFile(project / "report.zip") as zf:
         with zf.open("report.json") as stream:
             report = json.load(stream)
@@ -508,8 +741,7 @@ def result():
     path = REPORT / secrets.token_urlsafe()
     while path.exists():
         path = REPORT / secrets.token_urlsafe()
-    with path.open("w", encoding="utf-8", errors="replace") as out:
-        out.write(data)
+    save_page(path, data)
     permalink = url_for("report", name=str(path.name), _external=True)
     permalink_path = project / "permalink"
     with permalink_path.open("w", encoding="utf-8", errors="replace") as out:
@@ -518,13 +750,110 @@ def result():
     return redirect(permalink)
 
 
+# rendered pages are saved once with their compressed variants, and served with
+# an ETag so that browsers may revalidate them instead of downloading them again
+
+_page_variants = [("br", ".br"), ("gzip", ".gz")]
+
+
+def save_page(path, data):
+    raw = data.encode("utf-8", errors="replace")
+    path.with_suffix(".gz").write_bytes(gzip.compress(raw, compresslevel=9))
+    if brotli is not None:
+        path.with_suffix(".br").write_bytes(brotli.compress(raw))
+    path.write_bytes(raw)
+
+
+def send_page(path):
+    for encoding, suffix in _page_variants:
+        variant = path.with_suffix(suffix)
+        if request.accept_encodings[encoding] and variant.exists():
+            break
+    else:
+        encoding, variant = None, path
+    stat = variant.stat()
+    etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}-{encoding or 'raw'}"
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(variant.read_bytes(), status=200, mimetype="text/html")
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+    resp.set_etag(etag)
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+
+# zip archives are streamed to the client as they are built, members that are
+# already compressed being stored as is
+
+_compressed = {".zip", ".gz", ".bz2", ".xz", ".7z", ".xlsx", ".docx", ".odt",
+               ".png", ".jpg", ".jpeg", ".gif", ".mp4", ".pdf"}
+
+
+class _ZipSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def zip_stream(content):
+    "generate a zip of `content` (pairs of path and member name) as it is built"
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w") as zf:
+        for path, name in content:
+            info = zipfile.ZipInfo.from_file(path, name)
+            if pathlib.Path(name).suffix.lower() in _compressed:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, "rb") as src, zf.open(info, "w") as dst:
+                for block in iter(lambda: src.read(1 << 16), b""):
+                    dst.write(block)
+                    yield sink.take()
+            yield sink.take()
+    yield sink.take()
+
+
+def send_zip(content, name):
+    resp = Response(zip_stream(content), mimetype="application/zip")
+    resp.headers["Content-Disposition"] = f'attachment; filename="{name}"'
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+# only rendered pages and marks reports are served, not the listings of files
+# that marks archives are built from, nor the compressed variants of pages
+
+REPORT_SUFFIXES = {"", ".zip", ".xlsx"}
+
+
 @app.route("/report/<name>")
 @enforce_auth
 def report(name):
     path = REPORT / name
-    if path.exists():
+    listing = path.with_suffix(".json")
+    if path.suffix not in REPORT_SUFFIXES:
+        abort(404)
+    elif path.suffix == ".zip" and not path.exists() and listing.exists():
+        with listing.open(encoding="utf-8") as stream:
+            return send_zip(json.load(stream), path.name)
+    elif path.exists():
         if not path.suffix:
-            return path.read_text(encoding="utf-8")
+            return send_page(path)
         else:
             return send_file(
                 path.open("rb"), as_attachment=True, attachment_filename=path.name
@@ -545,11 +874,9 @@ def report(name):
 def teacher(path):
     groups = set()
     exos = collections.defaultdict(set)
-    for row in DB(DB.users.id == DB.submissions.user).select(
-        DB.users.group, DB.submissions.course, DB.submissions.exercise
-    ):
-        groups.add(row.users.group)
-        exos[row.submissions.course].add(row.submissions.exercise)
+    for row in DB().select(DB.catalogue.ALL):
+        groups.add(row.group)
+        exos[row.course].add(row.exercise)
     if request.method == "GET":
         if path:
             url = url_for("report", name=path)
@@ -582,23 +909,26 @@ def teacher(path):
 
 
 @app.route("/marks")
-@async_api
+@async_api(priority="report")
 def marks():
     check_auth(ROLE=ROLES.teacher, ERROR=401)
-    path = (REPORT / secrets.token_urlsafe()).with_suffix(".zip")
+    # only the spreadsheet and the list of files are saved, the archive is
+    # streamed from them when downloaded
+    path = (REPORT / secrets.token_urlsafe()).with_suffix(".json")
     while path.exists():
-        path = (REPORT / secrets.token_urlsafe()).with_suffix(".zip")
+        path = (REPORT / secrets.token_urlsafe()).with_suffix(".json")
     path.parent.mkdir(exist_ok=True, parents=True)
     argv = (
-        ["python3", "-m", "badass", "report", "-o", path]
+        ["report", "-o", path]
         + ["-d", "data"]
+        + ["-f", "bundle"]
         + ["-g"]
         + list(session["groups"])
         + ["-e"]
         + list(session["exos"])
     )
-    check_output(argv, env=ENV)
-    return redirect(url_for("teacher", path=str(path.name)))
+    grade(argv, priority="report")
+    return redirect(url_for("teacher", path=str(path.with_suffix(".zip").name)))
 
 
 ##
@@ -668,6 +998,22 @@ if not app.config["DEBUG"]:
     handle_exception = app.errorhandler(Exception)(handle_exception)
 
 
+@app.route("/queues")
+@enforce_auth
+@require_role(ROLES.dev)
+def queues():
+    tasks = TASKS.summary()
+    try:
+        grader = GRADER.queue()
+    except OSError:
+        # daemon is not running
+        grader = None
+    for row in itertools.chain(tasks, grader or []):
+        if row["oldest"] is not None:
+            row["oldest"] = datetime.fromtimestamp(row["oldest"]).strftime("%H:%M:%S")
+    return render_template("queues.html", tasks=tasks, grader=grader)
+
+
 @app.route("/errors")
 @enforce_auth
 @require_role(ROLES.dev)
@@ -736,16 +1082,17 @@ def src(subid):
         abort(404)
     if not (str(g.user.id) == str(row.user) or g.user.has_role("admin")):
         abort(401)
-    root = pathlib.Path(row.path) / "src"
-    todo = [root]
-    with tempfile.NamedTemporaryFile("wb") as tmp:
-        with zipfile.ZipFile(tmp, "w") as zf:
-            while todo:
-                path = todo.pop()
-                if path.is_dir():
-                    todo.extend(path.iterdir())
-                else:
-                    zf.write(path, path.relative_to(root))
-        tmp.flush()
-        tmp.seek(0)
-        return send_file(tmp.name, as_attachment=True, attachment_filename="src.zip")
+    base = pathlib.Path(row.path)
+    files, dirs = manifest(base) or ({}, set())
+    if "src" in dirs:
+        content = [
+            (blob, pathlib.Path(name).relative_to("src"))
+            for name, blob in files.items()
+            if name.startswith("src/")
+        ]
+    else:
+        root = base / "src"
+        content = [
+            (path, path.relative_to(root)) for path in root.rglob("*") if path.is_file()
+        ]
+    return send_zip(content, "src.zip")
@@ -73,5 +73,6 @@ setup(name="not-so-badass",
                         "chardet",
                         "tree-sitter",
                         "matplotlib"],
+      extras_require={"production" : ["gunicorn"]},
       package_data={"badass" : data},
       entry_points={"console_scripts": ["badass=badass.__main__:main"]})
@@ -0,0 +1,64 @@
+import subprocess, sys, os, json
+
+from pathlib import Path
+
+from badass.db.blobs import BlobStore, manifest, MANIFEST
+
+ROOT = Path(__file__).absolute().parent.parent
+
+SOURCE = "void setup () { size(10, 10); }\nvoid draw () { }\n"
+
+# grading that edits in place the sources it is given
+SCRIPT = """from badass.run import Test
+with Test("edited") as t :
+    with (t.test_dir / "src" / "a.pde").open("a") as out :
+        out.write("// edited\\n")
+    t.has("void setup()")
+"""
+
+def submission (root, name, files) :
+    base = root / name
+    for path, text in files.items() :
+        (base / path).parent.mkdir(parents=True, exist_ok=True)
+        (base / path).write_text(text)
+    return base
+
+def blobs (store) :
+    return sorted(p for p in store.root.rglob("*") if p.is_file())
+
+def test_identical (tmp_path) :
+    store = BlobStore(tmp_path / "store")
+    one = submission(tmp_path, "one", {"src/a.pde" : SOURCE, "src/b.pde" : "x"})
+    two = submission(tmp_path, "two", {"src/a.pde" : SOURCE, "src/c/b.pde" : "x"})
+    store.archive(one, one / "src")
+    store.archive(two, two / "src")
+    assert len(blobs(store)) == 2
+    assert (one / "src" / "a.pde").samefile(two / "src" / "a.pde")
+    assert (one / "src" / "b.pde").samefile(two / "src" / "c" / "b.pde")
+    files, dirs = manifest(two)
+    assert dirs == {"src"}
+    assert set(files) == {"src/a.pde", "src/c/b.pde"}
+    assert files["src/a.pde"].read_text() == SOURCE
+    assert json.loads((two / MANIFEST).read_text())["store"] == "../store"
+    assert manifest(tmp_path) is None
+
+def test_grading (tmp_path) :
+    store = BlobStore(tmp_path / "store")
+    one = submission(tmp_path, "one", {"src/a.pde" : SOURCE})
+    two = submission(tmp_path, "two", {"src/a.pde" : SOURCE})
+    store.archive(one, one / "src")
+    store.archive(two, two / "src")
+    (tmp_path / "script.py").write_text(SCRIPT)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([str(ROOT)]
+                                        + env.get("PYTHONPATH", "").split(os.pathsep))
+    subprocess.run([sys.executable, "-m", "badass", "-l", "processing", "run",
+                    "--keep", "script.py", "one"],
+                   cwd=tmp_path, env=env, check=True, capture_output=True)
+    edited, = one.glob("test-*/src/a.pde")
+    assert edited.read_text() == SOURCE + "// edited\n"
+    # sources are edited in a copy, not in the shared blob
+    blob, = blobs(store)
+    assert blob.read_text() == SOURCE
+    assert (two / "src" / "a.pde").read_text() == SOURCE
+    assert (one / "src" / "a.pde").samefile(blob)
@@ -0,0 +1,41 @@
+import datetime
+
+import pytest
+
+from badass.db import connect, catalogue_add
+
+@pytest.fixture
+def db (tmp_path) :
+    return connect(tmp_path)
+
+def submit (db, user, course, exercise) :
+    db.submissions.insert(user=user.id, date=datetime.datetime.now(),
+                          course=course, exercise=exercise, path="")
+    catalogue_add(db, course, exercise, user.id)
+    db.commit()
+
+def catalogue (db) :
+    return {(row.course, row.exercise, row.group)
+            for row in db().select(db.catalogue.ALL)}
+
+def test_catalogue (db) :
+    DB, CFG, USER, ROLES = db
+    ann = USER.add("ann@x", "Ann", "A", "pw", "g1", [], None)
+    bob = USER.add("bob@x", "Bob", "B", "pw", "g1", [], None)
+    ann = USER.from_email("ann@x")
+    bob = USER.from_email("bob@x")
+    submit(DB, ann, "c", "e1")
+    submit(DB, bob, "c", "e1")
+    submit(DB, bob, "c", "e2")
+    assert catalogue(DB) == {("c", "e1", "g1"), ("c", "e2", "g1")}
+    # only bob has submitted e2, so it moves with him
+    bob.update(group="g2")
+    assert catalogue(DB) == {("c", "e1", "g1"), ("c", "e1", "g2"), ("c", "e2", "g2")}
+    ann.update(firstname="Anna")
+    assert catalogue(DB) == {("c", "e1", "g1"), ("c", "e1", "g2"), ("c", "e2", "g2")}
+    ann.delete()
+    assert catalogue(DB) == {("c", "e1", "g2"), ("c", "e2", "g2")}
+    # a stale user (like the one of an older session) is added to its new group
+    submit(DB, bob, "c", "e3")
+    assert bob.group == "g1"
+    assert catalogue(DB) == {("c", "e1", "g2"), ("c", "e2", "g2"), ("c", "e3", "g2")}
@@ -0,0 +1,58 @@
+import subprocess, sys, os, time, signal
+
+from pathlib import Path
+
+from badass.www.grader import Client
+from badass.www.jobs import JobQueue, _alive
+
+ROOT = Path(__file__).absolute().parent.parent
+
+SCRIPT = """import time
+from badass.run import Test
+with Test("slow") as t :
+    time.sleep(60)
+"""
+
+def wait (check, timeout=20) :
+    end = time.time() + timeout
+    while not check() :
+        assert time.time() < end
+        time.sleep(0.1)
+
+def parent (pid) :
+    try :
+        return int(Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()[1])
+    except (OSError, TypeError) :
+        return None
+
+def test_terminate (tmp_path) :
+    (tmp_path / "data").mkdir()
+    (tmp_path / "p" / "src").mkdir(parents=True)
+    (tmp_path / "p" / "src" / "a.pde").write_text("void setup () { }\n")
+    (tmp_path / "slow.py").write_text(SCRIPT)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([str(ROOT)]
+                                        + env.get("PYTHONPATH", "").split(os.pathsep))
+    daemon = subprocess.Popen([sys.executable, "-m", "badass", "www", "--grader",
+                               "--jobs", "2"],
+                              cwd=tmp_path, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    sock = tmp_path / "data" / "grader.sock"
+    try :
+        wait(sock.exists)
+        num = Client(sock).submit(["-l", "processing", "run", "slow.py", "p"])
+        queue = JobQueue(tmp_path / "data" / "grader.sqlite")
+        # job is owned by the process that runs it, not by the worker
+        wait(lambda: parent(parent(queue.get(num)["owner"])) == daemon.pid)
+        owner = queue.get(num)["owner"]
+        assert queue.reclaim() == 0
+        daemon.send_signal(signal.SIGTERM)
+        daemon.wait(timeout=20)
+    finally :
+        if daemon.poll() is None :
+            daemon.kill()
+    assert not sock.exists()
+    assert not _alive(owner)
+    # job is queued again when the daemon restarts
+    assert queue.reclaim() == 1
+    assert queue.get(num)["state"] == "queued"
@@ -0,0 +1,144 @@
+import os, time, random
+
+import pytest
+
+from badass.www.jobs import JobQueue
+
+@pytest.fixture
+def queue (tmp_path) :
+    return JobQueue(tmp_path / "jobs.sqlite")
+
+def test_submit_take_finish (queue) :
+    num = queue.submit("grade", {"path" : "x"}, user="1")
+    job = queue.get(num)
+    assert job["state"] == "queued"
+    assert job["payload"] == {"path" : "x"}
+    job = queue.take()
+    assert job["id"] == num
+    assert job["state"] == queue.get(num)["state"] == "running"
+    assert queue.take() is None
+    queue.finish(num, {"status" : 200})
+    job = queue.get(num)
+    assert job["state"] == "done"
+    assert job["result"] == {"status" : 200}
+    queue.finish(num, "boom", failed=True)
+    assert queue.get(num)["state"] == "failed"
+    assert queue.get(num + 1) is None
+
+def test_count (queue) :
+    for n in range(3) :
+        queue.submit("grade", {})
+    queue.take()
+    assert queue.count() == 3
+    assert queue.count("queued") == 2
+    assert queue.count("queued", "running") == 3
+
+def test_priority (queue) :
+    batch = queue.submit("grade", {}, priority="batch")
+    report = queue.submit("marks", {}, priority="report")
+    inter = queue.submit("result", {}, priority="interactive")
+    assert [queue.take()["id"] for n in range(3)] == [inter, report, batch]
+
+def test_position (queue) :
+    first = queue.submit("grade", {}, priority="batch")
+    second = queue.submit("grade", {}, priority="batch")
+    urgent = queue.submit("result", {}, priority="interactive")
+    assert queue.position(urgent) == 0
+    assert queue.position(first) == 1
+    assert queue.position(second) == 2
+    queue.take()
+    assert queue.position(first) == 0
+
+def test_recover (queue) :
+    num = queue.submit("grade", {})
+    queue.take()
+    assert queue.recover() == 1
+    assert queue.get(num)["state"] == "queued"
+    assert queue.take()["id"] == num
+
+def test_purge (queue) :
+    old = queue.submit("grade", {})
+    new = queue.submit("grade", {})
+    running = queue.submit("grade", {})
+    for num in (old, new, running) :
+        queue.take()
+    queue.finish(old)
+    queue.finish(new)
+    queue._db.execute("UPDATE jobs SET finished = ? WHERE id = ?",
+                      (time.time() - 100, old))
+    assert queue.purge(50) == 1
+    assert queue.get(old) is None
+    assert queue.get(new)["state"] == "done"
+    assert queue.get(running)["state"] == "running"
+
+def test_fair_share (queue) :
+    a1 = queue.submit("grade", {}, user="a")
+    a2 = queue.submit("grade", {}, user="a")
+    b1 = queue.submit("grade", {}, user="b")
+    assert queue.take()["id"] == a1
+    # b has nothing running, so its job comes before the second one of a
+    assert queue.take()["id"] == b1
+    assert queue.take()["id"] == a2
+
+def test_cap (tmp_path) :
+    queue = JobQueue(tmp_path / "jobs.sqlite", cap=1)
+    a1 = queue.submit("grade", {}, user="a")
+    a2 = queue.submit("grade", {}, user="a")
+    anon = queue.submit("grade", {})
+    assert queue.take()["id"] == a1
+    # anonymous jobs are not capped
+    assert queue.take()["id"] == anon
+    assert queue.take() is None
+    queue.finish(a1)
+    assert queue.take()["id"] == a2
+
+def test_reclaim (tmp_path) :
+    path = tmp_path / "jobs.sqlite"
+    queue = JobQueue(path, cap=1)
+    num = queue.submit("grade", {}, user="a")
+    pid = os.fork()
+    if pid == 0 :
+        # take the job and die without finishing it
+        JobQueue(path, cap=1).take()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert queue.get(num)["owner"] == pid
+    job = queue.take()
+    assert job["id"] == num
+    assert job["owner"] == os.getpid()
+
+def test_reclaim_every (tmp_path) :
+    path = tmp_path / "jobs.sqlite"
+    queue = JobQueue(path, reclaim_every=3600)
+    assert queue.take() is None
+    num = queue.submit("grade", {})
+    pid = os.fork()
+    if pid == 0 :
+        JobQueue(path).take()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    # take has reclaimed already, it does not check the owners again so soon
+    assert queue.take() is None
+    assert queue.get(num)["owner"] == pid
+    assert queue.reclaim() == 1
+    assert queue.take()["id"] == num
+
+@pytest.mark.parametrize("cap", [None, 2])
+def test_position_order (tmp_path, cap) :
+    queue = JobQueue(tmp_path / "jobs.sqlite", cap=cap)
+    rnd = random.Random(cap)
+    for n in range(40) :
+        queue.submit("grade", {}, user=rnd.choice(["a", "b", "c", None]),
+                     priority=rnd.choice(["interactive", "report", "batch"]))
+        if rnd.random() < 0.2 :
+            queue.take()
+    queued = [row[0] for row in
+              queue._db.execute("SELECT id FROM jobs WHERE state = 'queued'")]
+    positions = sorted(queued, key=queue.position)
+    assert sorted(queue.position(n) for n in queued) == list(range(len(queued)))
+    taken = []
+    while (job := queue.take()) is not None :
+        taken.append(job["id"])
+    assert taken == positions[:len(taken)]
+    if cap is None :
+        assert len(taken) == len(queued)
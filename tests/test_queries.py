@@ -0,0 +1,143 @@
+import gc, weakref
+
+import pytest
+
+from jsonpath_ng.ext import parse as jp_parse
+
+from badass.lang.processing import Source
+from badass.run.queries import TQL, _Flat, h, query
+
+PROGRAM = """int fact (int n) {
+  if (n > 1) {
+    return n * fact(n - 1);
+  }
+  return 1;
+}
+
+int twice (int n) {
+  return 2 * n;
+}
+
+void loop (int n) {
+  for (int i = 0; i < n; i++) {
+    println(twice(i));
+  }
+  while (n > 0) {
+    n = n - 1;
+    loop(n);
+  }
+}
+
+void setup () {
+  size(10, 10);
+  println(fact(twice(3)));
+}
+"""
+
+OTHER = """void draw () {
+  if (mousePressed) {
+    ellipse(mouseX, mouseY, 10, 10);
+  }
+}
+
+int twice (int n) {
+  return 2 * n;
+}
+"""
+
+@pytest.fixture(scope="module")
+def ast (tmp_path_factory) :
+    path = tmp_path_factory.mktemp("src")
+    (path / "a.pde").write_text(PROGRAM)
+    (path / "b.pde").write_text(OTHER)
+    return Source(path).ast
+
+def tq (ast) :
+    return TQL([{k : v["treesitter"]} for k, v in ast.items()])
+
+def floordiv (tql, other) :
+    "`tql // other` computed level by level, as it was before flattening"
+    match = tql / other
+    for m in tql :
+        if isinstance(m, list) :
+            match.update(floordiv(TQL(m), other))
+        elif isinstance(m, dict) :
+            match.update(floordiv(TQL(m.values()), other))
+    return match
+
+def func (tql, name, recursive) :
+    "`tql.func(name, recursive=...)` computed as it was before flattening"
+    pat = {"kind" : "method_declaration"}
+    if name is not None :
+        pat["name"] = {"kind" : "identifier", "val" : name}
+    match = floordiv(tql, pat)
+    if recursive is None :
+        return match
+    return TQL(m for m in match
+               if bool(floordiv(TQL([m]), TQL.CALL(m["name"]["val"]))) == recursive)
+
+PATTERNS = [TQL.CALL(), TQL.CALL("twice"), TQL.CALL("nope"), TQL.LOOP(),
+            TQL.COND(), TQL.STMT("return"), {"kind" : "identifier"},
+            {"kind" : "method_declaration"},
+            TQL.OR({"kind" : "identifier", "val" : "n"}, TQL.CALL("println")),
+            TQL.AND({"kind" : "method_invocation"}, {"name" : {"val" : "println"}})]
+
+@pytest.mark.parametrize("pat", PATTERNS)
+def test_descendants (ast, pat) :
+    assert tq(ast) // pat == floordiv(tq(ast), pat)
+    for path, sub in ast.items() :
+        assert tq({path : sub}) // pat == floordiv(tq({path : sub}), pat)
+
+@pytest.mark.parametrize("recursive", [None, True, False])
+@pytest.mark.parametrize("name", [None, "fact", "twice", "loop"])
+def test_func (ast, name, recursive) :
+    tql = tq(ast)
+    found = tql.func(name=name, recursive=recursive)
+    assert found == func(tql, name, recursive)
+    if name is None :
+        assert len(tql.func()) == 5
+        expected = {True : {"fact", "loop"}, False : {"twice", "setup", "draw"},
+                    None : {"fact", "loop", "twice", "setup", "draw"}}
+        assert {m["name"]["val"] for m in found} == expected[recursive]
+    # methods are found in the flattening, the slow path is not needed
+    flats = [_Flat.get(m) for m in tql]
+    assert all(any(f.pos(m) is not None for f in flats) for m in found)
+
+def test_flat_lifetime () :
+    tree = h({"kind" : "block", "children" : [{"kind" : "identifier", "val" : "x"}]})
+    flat = _Flat.get(tree)
+    assert _Flat.get(tree) is flat
+    # an equal tree gets its own flattening, with its own nodes
+    other = h({"kind" : "block", "children" : [{"kind" : "identifier", "val" : "x"}]})
+    assert other == tree
+    assert _Flat.get(other) is not flat
+    assert _Flat.get(other).pos(other) == 0
+    assert flat.pos(other) is None
+    # the flattening does not keep its tree alive
+    ref = weakref.ref(tree)
+    del tree, flat
+    gc.collect()
+    assert ref() is None
+
+QUERIES = ["$..*[?kind='method_declaration']",
+           "$..*[?kind='method_invocation'].name.val",
+           "$..*[?kind='method_invocation' & name.val='twice'].arguments",
+           "$..*[?kind='identifier' & val='n']",
+           "$..*[?kind='for_statement'].body.children[0]",
+           "$..*[?kind='if_statement'].condition",
+           "$..*[?kind='nope']",
+           "$..*[?name='twice']",
+           "$..val"]
+
+@pytest.mark.parametrize("pattern", QUERIES)
+def test_query (ast, pattern) :
+    patt = jp_parse(pattern)
+    trees = {path : sub["treesitter"] for path, sub in ast.items()}
+    for tree in [trees, trees["a.pde"], trees["b.pde"]] :
+        found = list(query(pattern, tree))
+        expected = [m.value for m in patt.find(tree)]
+        # same nodes in the same order
+        assert [id(f) for f in found] == [id(e) for e in expected]
+        assert found == expected
+    # the patterns are not all trivially empty
+    assert list(query(pattern, trees)) or "'nope'" in pattern or "?name" in pattern
@@ -0,0 +1,107 @@
+import datetime, io, json, os, zipfile
+
+import pytest
+
+from badass.db import connect
+from badass.db.blobs import BlobStore
+from badass.report import Report, _DB
+
+def report_zip (path, statuses) :
+    "write a report.zip in `path` with tests of the given statuses"
+    csv = io.StringIO()
+    csv.write("test,status,text,auto\n")
+    for num, status in enumerate(statuses, 1) :
+        csv.write(f"{num},{status},test {num},False\n")
+    with zipfile.ZipFile(path / "report.zip", "w") as zf :
+        zf.writestr("report.csv", csv.getvalue())
+
+@pytest.fixture
+def data (tmp_path) :
+    "a database with two groups of students that submitted two exercises"
+    (tmp_path / "data").mkdir()
+    DB, CFG, USER, ROLES = connect(tmp_path / "data")
+    subs = {}
+    for num, (name, group) in enumerate([("ann", "g1"), ("bob", "g1"),
+                                         ("cat", "g2")]) :
+        USER.add(f"{name}@x", name, name, "pw", group, [], f"{num}")
+        user = USER.from_email(f"{name}@x")
+        for exo in ("e1", "e2") :
+            path = tmp_path / "upload" / "c" / exo / name
+            (path / "src").mkdir(parents=True)
+            (path / "src" / "main.c").write_text(f"/* {name} {exo} */\n")
+            report_zip(path, ["pass", "fail"])
+            DB.submissions.insert(user=user.id, date=datetime.datetime.now(),
+                                  course="c", exercise=exo, path=str(path))
+            subs[name, exo] = path
+    DB.commit()
+    return tmp_path / "data", subs
+
+def test_db_fetch (data) :
+    dbpath, subs = data
+    db = _DB(dbpath, ["g1"], ["c/e1", "c/e2"])
+    # all the submissions are fetched by one query, whatever the exercises
+    queries = [q for q, t in db.DB._timings if 'SELECT "users"."firstname"' in q]
+    assert len(queries) == 1
+    for exo in ("e1", "e2") :
+        assert {row.submissions.path for row in db.submissions("c", exo)} \
+            == {str(subs[name, exo]) for name in ("ann", "bob")}
+    assert list(db.submissions("c", "e3")) == []
+    assert list(_DB(dbpath, [], ["c/e1"]).submissions("c", "e1")) == []
+
+def test_score_cache (data) :
+    dbpath, subs = data
+    path = subs["ann", "e1"]
+    report = Report.__new__(Report)
+    score, marks = report._score(path, path / "report.zip")
+    assert score == 0.5
+    assert marks == {"1" : 0, "2" : 2}
+    cache = json.loads((path / Report.SCORE).read_text())
+    assert cache["score"] == score
+    # cache is used while report is unchanged
+    cache["score"] = 0.25
+    (path / Report.SCORE).write_text(json.dumps(cache))
+    assert report._score(path, path / "report.zip")[0] == 0.25
+    # and invalidated when report changes
+    report_zip(path, ["pass", "pass", "fail"])
+    assert report._score(path, path / "report.zip")[0] == pytest.approx(2 / 3)
+
+def test_bundle (data) :
+    dbpath, subs = data
+    path = subs["bob", "e2"]
+    BlobStore(dbpath.parent / "blobs").archive(path, path / "src")
+    (path / "progress.jsonl").write_text("{}\n")
+    rep = Report.from_db(dbpath, ["g1"], ["c/e2"], files="bundle", jobs=1)
+    assert len(rep.content) == 2
+    assert all(name.suffix == ".zip" for _, name in rep.content)
+    bundle = path / Report.BUNDLE
+    assert bundle in {cont for cont, _ in rep.content}
+    with zipfile.ZipFile(bundle) as zf :
+        assert sorted(zf.namelist()) == ["report.zip", "src/main.c"]
+        assert zf.read("src/main.c") == b"/* bob e2 */\n"
+    # bundle is reused while files are unchanged, and rebuilt otherwise
+    stat = bundle.stat()
+    Report.from_db(dbpath, ["g1"], ["c/e2"], files="bundle", jobs=1)
+    assert bundle.stat().st_mtime_ns == stat.st_mtime_ns
+    report_zip(path, ["pass", "pass", "pass"])
+    Report.from_db(dbpath, ["g1"], ["c/e2"], files="bundle", jobs=1)
+    with zipfile.ZipFile(bundle) as zf :
+        assert zf.read("report.zip") == (path / "report.zip").read_bytes()
+
+@pytest.mark.parametrize("files", ["copy", "bundle", "none"])
+def test_save_listing (data, tmp_path, files) :
+    dbpath, subs = data
+    rep = Report.from_db(dbpath, ["g1", "g2"], ["c/e1", "c/e2"], files=files)
+    listing = tmp_path / "report.json"
+    rep.save_listing(listing)
+    content = json.loads(listing.read_text())
+    assert content[0] == [str(listing.with_suffix(".xlsx").absolute()), "report.xlsx"]
+    assert all(os.path.isabs(path) and os.path.exists(path) for path, _ in content)
+    # a write-only workbook can be saved only once
+    rep = Report.from_db(dbpath, ["g1", "g2"], ["c/e1", "c/e2"], files=files)
+    rep.save(tmp_path / "report.zip")
+    with zipfile.ZipFile(tmp_path / "report.zip") as zf :
+        assert zf.namelist() == [name for _, name in content]
+    if files == "none" :
+        assert len(content) == 1
+    else :
+        assert len(content) > 1
@@ -0,0 +1,48 @@
+import subprocess, sys, zipfile, io, os
+
+from pathlib import Path
+
+SCRIPT = """from badass.run import Test, CONFIG
+with Test(f"project {CONFIG.project}") as t :
+    t.has("void setup()")
+with Test("draw") as t :
+    t.has("void draw()")
+"""
+
+PROJECTS = {"p1" : "void setup () { size(10, 10); }\nvoid draw () { }\n",
+            "p2" : "void setup () { size(20, 20); }\n"}
+
+ROOT = Path(__file__).absolute().parent.parent
+
+def badass (cwd, *args) :
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([str(ROOT)]
+                                        + env.get("PYTHONPATH", "").split(os.pathsep))
+    subprocess.run([sys.executable, "-m", "badass", "-l", "processing", "run"]
+                   + list(args), cwd=cwd, env=env, check=True, capture_output=True)
+
+def content (data) :
+    "content of a zip archive, with nested archives expanded"
+    with zipfile.ZipFile(io.BytesIO(data)) as zf :
+        return {name : (content(zf.read(name)) if name.endswith(".zip")
+                        else zf.read(name))
+                for name in zf.namelist()}
+
+def setup (root) :
+    root.mkdir()
+    (root / "script.py").write_text(SCRIPT)
+    for name, src in PROJECTS.items() :
+        (root / name / "src").mkdir(parents=True)
+        (root / name / "src" / f"{name}.pde").write_text(src)
+
+def test_batch (tmp_path) :
+    single, batch = tmp_path / "single", tmp_path / "batch"
+    setup(single)
+    setup(batch)
+    for name in PROJECTS :
+        badass(single, "script.py", name)
+    badass(batch, "--batch", "--jobs", "2", "script.py", *PROJECTS)
+    for name in PROJECTS :
+        report = content((single / name / "report.zip").read_bytes())
+        assert report
+        assert content((batch / name / "report.zip").read_bytes()) == report
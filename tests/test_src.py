@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+from badass.lang.src import SourceFile
+
+SOURCES = [b"int x = 1;",
+           b"int main () { return 0; }",
+           b"int f (int x) { if (x) { return x; } else { return -x; } }",
+           # syntax errors
+           b"x",
+           b"x y",
+           b"}{",
+           b"int main () { return 0 }",
+           b"int f (int x) { x = ; }",
+           b"int f () { if (x) { y( } }"]
+
+def count (node) :
+    if isinstance(node, list) :
+        return sum(count(n) for n in node)
+    elif isinstance(node, dict) :
+        return 1 + sum(count(v) for k, v in node.items() if k != "_path")
+    return 0
+
+@pytest.mark.parametrize("src", SOURCES)
+@pytest.mark.parametrize("clean", [True, False])
+def test_compact_dump (src, clean) :
+    full = SourceFile.parse(src, clean=clean).ast
+    compact = SourceFile.parse(src, clean=clean, compact=True).ast
+    assert compact == full
+    assert full == compact
+    # no unreachable nodes are left in the arrays
+    assert len(compact._ast_) == count(full)
+
+PROGRAM = b"""#include <stdio.h>
+
+int square (int x) {
+  return x * x;
+}
+
+int sum (int *t, int n) {
+  int s = 0;
+  for (int i = 0; i < n; i++) {
+    s += t[i];
+  }
+  return s;
+}
+
+int main () {
+  int t[3] = {1, 2, 3};
+  printf("%d %d\\n", square(4), sum(t, 3));
+  return 0;
+}
+"""
+
+SNIPPETS = [b"", b" ", b"\n", b"y", b"42", b"int z = 1;", b"/* c */", b"}", b"(x)"]
+
+def ranges (node) :
+    if isinstance(node, list) :
+        return [ranges(n) for n in node]
+    elif isinstance(node, dict) :
+        return {k : ranges(v) for k, v in node.items()}
+    return node
+
+@pytest.mark.parametrize("seed", range(20))
+def test_incremental_dump (seed) :
+    rnd = random.Random(seed)
+    src = SourceFile.parse(PROGRAM)
+    for step in range(5) :
+        old = src.ast
+        before = ranges(old)
+        pos = sorted(rnd.sample(range(len(src.src) + 1), 4))
+        edits = [(pos[0], pos[1], rnd.choice(SNIPPETS)),
+                 (pos[2], pos[3], rnd.choice(SNIPPETS))]
+        with src.batch() :
+            for start, end, txt in edits :
+                src[start, end] = txt
+        # edits are expressed on the source as it was before the batch
+        expected = (PROGRAM if step == 0 else expected)
+        expected = (expected[:pos[0]] + edits[0][2] + expected[pos[1]:pos[2]]
+                    + edits[1][2] + expected[pos[3]:])
+        assert src.src == expected
+        assert src.ast == src._dump_node(src.tstree.root_node)
+        # previous dump is left as it was
+        assert ranges(old) == before